@@ -1,15 +1,11 @@
 import os
 import sys
+import time
 
 import click
 
-import hew.action
-import hew.core
-import hew.stt
-import hew.qt5
-import hew.vlc
-import hew.subtitles
-
+from hew.recognizers import RECOGNIZERS
+from hew.startup import ImportReport, write_build_report
 from hew.util import Scheme, downloads_path
 
 
@@ -21,28 +17,82 @@ DIR = click.Path(exists=True, file_okay=False, dir_okay=True)
 @click.option('--bookmarks', default=None)
 @click.option('--video-no-sound', is_flag=True)
 @click.option('--video-no-resize', is_flag=True)
+@click.option('--video-copy', is_flag=True,
+              help='stream copy video hews without resizing and normalizing')
+@click.option('--hew-queue-size', type=int, default=4,
+              help='max number of hews running or waiting in background')
+@click.option('--hash', 'hash_name', type=click.Choice(['sha1', 'blake2b']), default='sha1',
+              help='hash to name hewn files by')
+@click.option('--export-cache-size', type=int, default=2048,
+              help='max size in MB of the cache of hewn files, 0 to disable')
+@click.option('--stt-engine', type=click.Choice(sorted(RECOGNIZERS)), default='google',
+              help='speech recognizer to use')
+@click.option('--stt-model', type=click.Path(exists=True), default=None,
+              help='path to the model of an offline speech recognizer, e.g. vosk')
+@click.option('--stt-concurrency', type=int, default=None,
+              help='max number of chunks recognized at once, '
+                   'defaults to 4 for google and the number of CPUs for vosk')
+@click.option('--stt-endpoint', default=None,
+              help='host:port of a server speaking the Google Cloud STT API '
+                   'to use instead of Google Cloud')
+@click.option('--stt-speculative', type=int, default=0,
+              help='recognize each hew in background right after it is done, '
+                   'with at most this many at once, 0 to disable')
+@click.option('--transcript-cache-size', type=int, default=16,
+              help='max size in MB of the cache of recognized transcripts, 0 to disable')
 @click.option('--yt', is_flag=True)
 @click.option('--yt-quality', default='720p', help='one of 360p, 720p, 1080p')
 @click.option('--yt-itag', default=None, type=int, help='overrides yt-quality')
+@click.option('--yt-cache-size', type=int, default=8192,
+              help='max size in MB of the cache of YouTube videos, 0 to download to Downloads')
+@click.option('--yt-cache-ttl', type=int, default=30,
+              help='days to keep YouTube videos not opened in the cache')
+@click.option('--yt-connections', type=int, default=4,
+              help='number of connections to download a YouTube video over')
 @click.option('--right-duration', type=int, default=1000)
 @click.option('--convert-wav', is_flag=True)
 @click.option('--snapshot-dir', type=DIR)
 @click.option('--srt-padding', type=int, default=5000)
 @click.option('--vlc-quiet/--vlc-no-quiet', default=True)
+@click.option('--build-workers', type=int, default=4,
+              help='number of threads to build independent targets at startup')
+@click.option('--warm/--no-warm', default=True,
+              help='build lazy targets in background once the window is shown')
+@click.option('--startup-report', is_flag=True,
+              help='print time spent importing modules until the window is shown')
+@click.option('--build-report', type=click.Path(dir_okay=False), default=None,
+              help='write time spent on each target as JSON, or Graphviz dot for .dot/.gv')
 @click.argument('source')
 @click.argument('start-at', default=None, required=False)
 def cli(anki_media,
         bookmarks,
         video_no_sound,
         video_no_resize,
+        video_copy,
+        hew_queue_size,
+        hash_name,
+        export_cache_size,
+        stt_engine,
+        stt_model,
+        stt_concurrency,
+        stt_endpoint,
+        stt_speculative,
+        transcript_cache_size,
         yt,
         yt_quality,
         yt_itag,
+        yt_cache_size,
+        yt_cache_ttl,
+        yt_connections,
         right_duration,
         convert_wav,
         snapshot_dir,
         srt_padding,
         vlc_quiet,
+        build_workers,
+        warm,
+        startup_report,
+        build_report,
         source,
         start_at):
 
@@ -50,6 +100,21 @@ def cli(anki_media,
     # To make sure the process has persmission to write in CWD, just change CWD to ~/Downloads
     os.chdir(downloads_path())
 
+    started = time.perf_counter()
+    import_report = ImportReport()
+    if startup_report:
+        import_report.install()
+
+    # NOTE: Import here so that '--help' or invalid arguments don't pay for
+    # loading Qt, VLC and moviepy. Dependencies only some sessions need,
+    # like pytube and google-cloud-speech, are imported where they are used.
+    import hew.action
+    import hew.core
+    import hew.stt
+    import hew.qt5
+    import hew.vlc
+    import hew.subtitles
+
     scheme = Scheme(hew.action.scheme,
                     hew.core.scheme,
                     hew.stt.scheme,
@@ -70,8 +135,21 @@ def cli(anki_media,
         'bookmarks': bookmarks,
         'video_no_sound': video_no_sound,
         'video_no_resize': video_no_resize,
+        'video_copy': video_copy,
+        'hew_queue_size': hew_queue_size,
+        'hash_name': hash_name,
+        'export_cache_size': export_cache_size,
+        'stt_engine': stt_engine,
+        'stt_model': stt_model,
+        'stt_concurrency': stt_concurrency,
+        'stt_endpoint': stt_endpoint,
+        'stt_speculative': stt_speculative,
+        'transcript_cache_size': transcript_cache_size,
         'yt': yt,
         'yt_itag': yt_itag,
+        'yt_cache_size': yt_cache_size,
+        'yt_cache_ttl': yt_cache_ttl,
+        'yt_connections': yt_connections,
         'right_duration': right_duration,
         'convert_wav': convert_wav,
         'snapshot_dir': snapshot_dir,
@@ -81,7 +159,16 @@ def cli(anki_media,
         'start_at': start_at,
     }
 
-    scheme.build(ctx)
+    scheme.build(ctx, max_workers=build_workers)
+    if warm:
+        scheme.warm()
+
+    if startup_report:
+        import_report.uninstall()
+        import_report.print(total=time.perf_counter() - started)
+    if build_report is not None:
+        write_build_report(scheme, build_report)
+
     sys.exit(ctx['app'].exec_())
 
 
@@ -1,18 +1,20 @@
 from collections import OrderedDict
 import os
 from pathlib import Path
-import shutil
 
-import moviepy.audio.fx.all as afx
 import pyperclip
 import pysrt
 
+from hew.export import export_audio, export_video
+from hew.loudness import SNAP_WINDOW_MS
 from hew.util import (
     format_timedelta, format_timedelta_range, remove_tags, Scheme,
-    tempfile_path, downloads_path, sha1of)
+    tempfile_path, downloads_path)
 
 
-scheme = Scheme()
+# NOTE: Most of actions touch Qt widgets or VLC players
+# either when built or when called.
+scheme = Scheme(main_thread=True)
 
 
 @scheme
@@ -49,55 +51,124 @@ def pause(show_action):
 
 
 @scheme
-def seek(main_vlc, clamp, show_action):
+def seek(main_vlc, clamp, wait_seekable, show_action):
     def f(ms):
-        t = main_vlc.get_time() + ms
-        main_vlc.set_time(clamp(t))
+        t = clamp(main_vlc.get_time() + ms)
+        wait_seekable(t)
+        main_vlc.set_time(t)
         show_action('%+ds' % (ms/1000))
     return f
 
 
 @scheme
-def mark(main_vlc, state, show_action, update_mark):
+def mark(main_vlc, state, loudness_index, subtitles_pri_map, clamp, show_action, update_mark):
+    def snap(t, side):
+        # NOTE: Prefer a boundary of the primary subtitles cue nearby,
+        # since they are timed by hand, then fall back to silences.
+        _, spec = subtitles_pri_map.current()
+        _, srt = spec
+        if srt is not None:
+            snapped = srt.snap(t, side)
+            if snapped is not None and abs(snapped - t) <= SNAP_WINDOW_MS:
+                return snapped
+        return loudness_index.snap(t, side)
+
     def f(side):
         assert side == 'left' or side == 'right'
         # NOTE: Ensure that newly marked hewn to be played at start(left).
         state['last_hewn_side'] = 'left'
-        state[side] = main_vlc.get_time()
-        show_action('%s' % side)
+        t = main_vlc.get_time()
+        snapped = (snap(t, side) if state['snap'] else
+                   None)
+        if snapped is None:
+            state[side] = t
+            show_action('%s' % side)
+        else:
+            state[side] = clamp(snapped)
+            show_action('%s snap %+dms' % (side, snapped - t))
         update_mark(state['left'], state['right'])
     return f
 
 
 @scheme
-def adjust(state, clamp, show_action, update_mark):
+def adjust(state, loudness_index, clamp, show_action, update_mark):
     def f(side, ms):
         assert side == 'left' or side == 'right'
-        t = state[side] + ms
         # NOTE: Adjusting means that the user cares that side.
         # So keep this state to play on that side after hewing
         state['last_hewn_side'] = side
-        state[side] = clamp(t)
-        show_action('%s %+dms' % (side, ms))
+        # NOTE: In snap mode, jump to the next silence in the direction instead,
+        # or step as usual if there is none nearby.
+        snapped = (loudness_index.snap(state[side], side, direction=ms) if state['snap'] else
+                   None)
+        if snapped is None:
+            state[side] = clamp(state[side] + ms)
+            show_action('%s %+dms' % (side, ms))
+        else:
+            show_action('%s snap %+dms' % (side, snapped - state[side]))
+            state[side] = clamp(snapped)
         update_mark(state['left'], state['right'])
     return f
 
 
+@scheme
+def mark_cue(main_vlc, state, subtitles_pri_map, clamp, show_action, update_mark):
+    def f():
+        # NOTE: Mark both sides on the primary subtitles cue being played,
+        # even if the subtitles are not shown.
+        _, spec = subtitles_pri_map.current()
+        _, srt = spec
+        if srt is None:
+            return
+
+        cue = srt.at(main_vlc.get_time())
+        if cue is None:
+            show_action('mark-cue: no cue')
+            return
+
+        start, end, _ = cue
+        state['last_hewn_side'] = 'left'
+        state['left'] = clamp(start)
+        state['right'] = clamp(end)
+        show_action('mark-cue')
+        update_mark(state['left'], state['right'])
+    return f
+
+
+@scheme
+def toggle_snap(state, loudness_index, show_action):
+    def f():
+        state['snap'] = not state['snap']
+        status = 'on' if state['snap'] else 'off'
+        if state['snap'] and not loudness_index.ready:
+            status += ' (indexing)'
+        show_action('snap: %s' % status)
+    return f
+
+
 @scheme
 def hew(main_vlc,
-        sub_vlc,
         get_current_target_path,
         video_no_sound,
         video_no_resize,
+        video_copy,
+        main_path,
         main_view,
+        has_video,
         video,
         audio,
         state,
-        compose_subtitles_baked_clip,
+        subtitles_to_bake,
+        loudness_index,
         srt_padding,
+        hash_name,
+        export_cache,
+        hew_queue,
         clip_anki,
         clip_downloads,
-        play_hewn):
+        play_hewn,
+        speculative_stt,
+        source_download):
 
     def f():
         dirname = get_current_target_path()
@@ -106,49 +177,63 @@ def hew(main_vlc,
         if left >= right:
             return
 
-        main_vlc.set_pause(1)
-        if state['try_video'] and video is not None:
-            hewn = subclip(video, left, right)
-            temppath = tempfile_path('.mp4')
-            ffmpeg_params = []
+        # NOTE: Read everything the job needs here in the Qt thread,
+        # because the user may keep marking while the job is running.
+        current_target = state['current_target']
+        gain = loudness_index.gain(left, right)
+        has_sound = True
+        if state['try_video'] and has_video:
+            has_sound = not video_no_sound
+            size = None
             if not video_no_resize:
-                w, h = main_view.width(), main_view.height()
-                # ffmpeg requires sizes to be even
-                w, h = (w//2)*2, (h//2)*2
-                ffmpeg_params.extend(['-vf', 'scale=%s:%s' % (w, h)])
-
-            composed = compose_subtitles_baked_clip(
-                hewn, left, right, srt_padding)
-
-            # Codecs chosen for HTML5
-            composed.write_videofile(temppath,
-                                     codec='libx264',
-                                     audio=not video_no_sound,
-                                     audio_codec='aac',
-                                     ffmpeg_params=ffmpeg_params)
-            filename = sha1of(temppath) + '.mp4'
-            filepath = os.path.join(dirname, filename)
-            shutil.move(temppath, filepath)
-            if state['current_target'] == 'anki':
-                clip_anki(filename)
-            else:
-                clip_downloads(filepath)
+                size = (main_view.width(), main_view.height())
+            tracks = subtitles_to_bake()
+
+            def work(job):
+                return export_video(main_path, video, left, right, dirname,
+                                    size=size,
+                                    audio=has_sound,
+                                    copy=video_copy,
+                                    tracks=tracks,
+                                    srt_padding=srt_padding,
+                                    gain=gain,
+                                    hash_name=hash_name,
+                                    cache=export_cache,
+                                    logger=job.logger)
         else:
-            hewn = subclip(audio, left, right)
-            temppath = tempfile_path('.mp3')
-            hewn.write_audiofile(temppath)
-            filename = sha1of(temppath) + '.mp3'
-            filepath = os.path.join(dirname, filename)
-            shutil.move(temppath, filepath)
-            if state['current_target'] == 'anki':
-                clip_anki(filename)
+            def work(job):
+                return export_audio(audio, left, right, dirname,
+                                    gain=gain,
+                                    hash_name=hash_name,
+                                    cache=export_cache,
+                                    logger=job.logger)
+
+        if source_download is not None and not source_download.finished:
+            export = work
+
+            def work(job):
+                # NOTE: Parts not downloaded yet are zeros on disk,
+                # and the export cache key needs the complete file.
+                source_download.wait()
+                return export(job)
+
+        def done(result):
+            filepath, start = result
+            if current_target == 'anki':
+                clip_anki(os.path.basename(filepath))
             else:
                 clip_downloads(filepath)
 
-        state['last_hewn_path'] = filepath
-        state['last_left'] = left
-        state['last_right'] = right
-        play_hewn()
+            state['last_hewn_path'] = filepath
+            # NOTE: Stream copies start earlier than 'left'
+            state['last_left'] = start
+            state['last_right'] = right
+            if speculative_stt is not None and has_sound:
+                speculative_stt.submit(filepath)
+            play_hewn()
+
+        main_vlc.set_pause(1)
+        hew_queue.submit('hew', work, done)
 
         # Seek to the right end
         main_vlc.set_time(right)
@@ -156,11 +241,11 @@ def hew(main_vlc,
     return f
 
 
-def subclip(clip, left, right):
-    return (
-        clip.subclip(left/1000., right/1000.)
-            .fx(afx.audio_normalize)
-    )
+@scheme
+def cancel_hew(hew_queue):
+    def f():
+        hew_queue.cancel_last()
+    return f
 
 
 @scheme
@@ -203,7 +288,7 @@ def dump_srt(state,
         right = state['right']
         ss = srt.slice(starts_after=left - srt_padding,
                        ends_before=right + srt_padding)
-        transcript = ' '.join(remove_tags(s.text) for s in ss)
+        transcript = ' '.join(remove_tags(text) for _, _, text in ss)
         clip(transcript.strip())
         show_action('dump-srt')
 
@@ -213,6 +298,8 @@ def dump_srt(state,
 @scheme
 def dump_recognized(state,
                     recognize_speech,
+                    speculative_stt,
+                    transcript_index,
                     clip,
                     show_action):
 
@@ -221,12 +308,29 @@ def dump_recognized(state,
         if not path:
             return
 
-        transcript = recognize_speech(path)
+        # NOTE: Slice the transcript of the whole source if indexed,
+        # as dump_srt does with subtitles.
+        transcript = transcript_index.transcript(state['left'], state['right'])
+        if transcript is None and speculative_stt is not None:
+            transcript = speculative_stt.result(path)
+        if transcript is None:
+            transcript = recognize_speech(path)
         clip(transcript.strip())
         show_action('dump-recognized')
     return f
 
 
+@scheme
+def index_transcript(transcript_index, recognize_words, show_action):
+    def f():
+        if transcript_index.ready:
+            show_action('index-transcript: ready')
+            return
+        transcript_index.build_in_background(recognize_words)
+        show_action('index-transcript: building')
+    return f
+
+
 @scheme
 def dump_primary(subtitles_pri_map, dump_srt, dump_recognized):
     # NOTE: if subtitles exist, dump_srt should be primary
@@ -245,8 +349,8 @@ def play_hewn(main_vlc, sub_vlc, sub_view, state, set_current_player, show_actio
     def f(side=None):
         path = state['last_hewn_path']
         side = state['last_hewn_side'] if side is None else side
-        left = state['left']
-        right = state['right']
+        left = state['last_left']
+        right = state['last_right']
         if not path:
             return
 
@@ -339,8 +443,9 @@ def reload_(main_vlc, main_path, set_current_player, subtitles_pri_map, show_act
 
 
 @scheme
-def set_position(main_vlc):
+def set_position(main_vlc, wait_seekable):
     def f(ms):
+        wait_seekable(ms)
         main_vlc.set_time(ms)
     return f
 
@@ -429,7 +534,7 @@ def init_mark_label(update_mark):
 
 
 @scheme
-def resize(screen, window, main_view, sub_view, video, state):
+def resize(screen, window, main_view, sub_view, video_size, state):
     def f(x, absolute=False):
         if main_view is None:
             return
@@ -441,7 +546,7 @@ def resize(screen, window, main_view, sub_view, video, state):
         else:
             scale = state['scale'] * x
 
-        w, h = video.size
+        w, h = video_size
         width = max(64, w*scale)
         height = max(64, h*scale)
         if w*scale == width and h*scale == height:
@@ -459,7 +564,7 @@ BOOKMARK_EPSILON = 2.0
 
 
 @scheme
-def prev_bookmark(main_vlc, bookmarks, state, clamp, show_action):
+def prev_bookmark(main_vlc, bookmarks, state, clamp, wait_seekable, show_action):
     def f():
         if bookmarks is None:
             return
@@ -472,13 +577,15 @@ def prev_bookmark(main_vlc, bookmarks, state, clamp, show_action):
         # Only keep before_jump when current not in bookmarks
         if all(map(lambda s: abs(current - s) > BOOKMARK_EPSILON, bookmarks)):
             state['before_jump'] = current
-        main_vlc.set_time(clamp(int(prev_s * 1000)))
+        t = clamp(int(prev_s * 1000))
+        wait_seekable(t)
+        main_vlc.set_time(t)
         show_action('prev_bookmark')
     return f
 
 
 @scheme
-def next_bookmark(main_vlc, bookmarks, state, clamp, show_action):
+def next_bookmark(main_vlc, bookmarks, state, clamp, wait_seekable, show_action):
     def f():
         if bookmarks is None:
             return
@@ -491,18 +598,22 @@ def next_bookmark(main_vlc, bookmarks, state, clamp, show_action):
         # Only keep before_jump when current not in bookmarks
         if all(map(lambda s: abs(current - s) > BOOKMARK_EPSILON, bookmarks)):
             state['before_jump'] = current
-        main_vlc.set_time(clamp(int(next_s * 1000)))
+        t = clamp(int(next_s * 1000))
+        wait_seekable(t)
+        main_vlc.set_time(t)
         show_action('next_bookmark')
     return f
 
 
 @scheme
-def return_before_jump(main_vlc, state, clamp, show_action):
+def return_before_jump(main_vlc, state, clamp, wait_seekable, show_action):
     def f():
         before_jump = state['before_jump']
         if before_jump is None:
             return
-        main_vlc.set_time(clamp(int(before_jump * 1000)))
+        t = clamp(int(before_jump * 1000))
+        wait_seekable(t)
+        main_vlc.set_time(t)
         show_action('return_before_jump')
     return f
 
@@ -531,6 +642,7 @@ def toggle_subtitles(main_view, main_vlc, subtitles_pri_map, show_action, update
         spu, spec = subtitles_pri_map.current()
         main_vlc.video_set_spu(spu)
         status = 'enabled' if subtitles_pri_map.enabled else 'disabled'
+        subtitles_pri_map.preload()
         show_action(f'subtitles_pri: {status}')
         update_subtitles_pri_label()
     return f
@@ -543,6 +655,7 @@ def cycle_subtitles(main_view, main_vlc, subtitles_pri_map, show_action, toggle_
         spu, spec = subtitles_pri_map.current()
         name, _ = spec
         main_vlc.video_set_spu(spu)
+        subtitles_pri_map.preload()
         show_action(f'subtitles_pri: {name}')
         update_subtitles_pri_label()
     return f
@@ -557,6 +670,7 @@ def toggle_subtitles_aux(main_view, subtitles_aux_map, show_action, update_subti
     def f():
         subtitles_aux_map.enabled = not subtitles_aux_map.enabled
         status = 'enabled' if subtitles_aux_map.enabled else 'disabled'
+        subtitles_aux_map.preload()
         show_action(f'subtitles_aux: {status}')
         update_subtitles_aux_label()
     return f
@@ -568,6 +682,7 @@ def cycle_subtitles_aux(main_view, subtitles_aux_map, show_action, toggle_subtit
         subtitles_aux_map.cycle()
         _, spec = subtitles_aux_map.current()
         name, _ = spec
+        subtitles_aux_map.preload()
         show_action(f'subtitles_aux: {name}')
         update_subtitles_aux_label()
 
@@ -575,12 +690,12 @@ def cycle_subtitles_aux(main_view, subtitles_aux_map, show_action, toggle_subtit
 
 
 @scheme
-def yank_source(youtube, source, source_path, clip, show_action):
+def yank_source(youtube_entry, source, source_path, clip, show_action):
     def f():
-        if youtube is None:
+        if youtube_entry is None:
             clip(source_path)
         else:
-            atag = '<a href="%s">%s</a>' % (source, youtube.title)
+            atag = '<a href="%s">%s</a>' % (source, youtube_entry['title'])
             clip(atag)
         show_action('yank-source')
     return f
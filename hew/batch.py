@@ -0,0 +1,215 @@
+from concurrent.futures import ProcessPoolExecutor
+import json
+import re
+import sys
+
+import click
+from moviepy.audio.io.AudioFileClip import AudioFileClip
+from moviepy.video.io.VideoFileClip import VideoFileClip
+
+from hew.cache import ExportCache, ProbeCache
+from hew.cues import Cues
+from hew.export import export_audio, export_video
+from hew.ffmpeg import probe
+from hew.loudness import LoudnessIndex
+from hew.util import cache_path, downloads_path, remove_tags, try_pytimeparse, try_seconds
+
+
+FILE = click.Path(exists=True, file_okay=True, dir_okay=False)
+DIR = click.Path(exists=True, file_okay=False, dir_okay=True)
+
+
+@click.command()
+@click.option('--ranges', type=FILE, default=None,
+              help='a file of "left right" lines, one per clip')
+@click.option('--srt', type=FILE, default=None,
+              help='one clip per cue unless --ranges is given')
+@click.option('--srt-aux', type=FILE, default=None)
+@click.option('--cue-padding', type=int, default=0)
+@click.option('--bake', is_flag=True, help='bake --srt and --srt-aux into videos')
+@click.option('--audio-only', is_flag=True)
+@click.option('--video-no-sound', is_flag=True)
+@click.option('--video-copy', is_flag=True)
+@click.option('--size', default=None, help='resize videos to WxH')
+@click.option('--srt-padding', type=int, default=5000)
+@click.option('--output-dir', type=DIR, default=None)
+@click.option('--hash', 'hash_name', type=click.Choice(['sha1', 'blake2b']), default='sha1',
+              help='hash to name hewn files by')
+@click.option('--export-cache-size', type=int, default=2048,
+              help='max size in MB of the cache of hewn files, 0 to disable')
+@click.option('--jobs', type=int, default=None,
+              help='number of worker processes, defaults to the number of cores')
+@click.argument('source', type=FILE)
+def cli(ranges,
+        srt,
+        srt_aux,
+        cue_padding,
+        bake,
+        audio_only,
+        video_no_sound,
+        video_copy,
+        size,
+        srt_padding,
+        output_dir,
+        hash_name,
+        export_cache_size,
+        jobs,
+        source):
+
+    if ranges is None and srt is None:
+        raise click.UsageError('Either --ranges or --srt is required')
+
+    if size is not None:
+        w, h = size.lower().split('x')
+        size = (int(w), int(h))
+
+    tracks = []
+    if bake:
+        tracks = [(path, vpos) for path, vpos in ((srt, 'bottom'), (srt_aux, 'top'))
+                  if path is not None]
+
+    probe_cache = ProbeCache(cache_path('media'))
+    info = probe_cache.get(source, probe)
+    has_video = info['video'] is not None
+
+    # NOTE: Check every range before hewing any,
+    # rather than failing halfway through the batch.
+    # Cues left empty after clamping to the source, e.g. ones past its end,
+    # are skipped and reported in their entries instead.
+    if ranges is not None:
+        clips = read_ranges(ranges)
+    else:
+        clips = read_cues(srt, cue_padding, info['duration'])
+    for left, right, _ in clips:
+        if ranges is None and left >= right:
+            continue
+        if not 0 <= left < right <= info['duration']:
+            raise click.BadParameter("Invalid range: %d-%d ms, the source is %d ms long" %
+                                     (left, right, info['duration']))
+
+    # NOTE: Decoding the source once for all ranges is cheaper than
+    # normalizing each range on its own.
+    loudness_index = LoudnessIndex(source, probe_cache.dirpath)
+    loudness_index.build()
+
+    opts = {
+        'source_path': source,
+        'try_video': has_video and not audio_only,
+        'dirname': output_dir or downloads_path(),
+        'size': size,
+        'sound': not video_no_sound,
+        'copy': video_copy,
+        'tracks': tracks,
+        'srt_padding': srt_padding,
+        'hash_name': hash_name,
+        'cache': (ExportCache(cache_path('exports'), export_cache_size * 1024 * 1024)
+                  if export_cache_size > 0 else None),
+    }
+
+    with ProcessPoolExecutor(max_workers=jobs,
+                             initializer=init_worker,
+                             initargs=(opts,)) as executor:
+        futures = [(executor.submit(hew_range, (l, r, loudness_index.gain(l, r)))
+                    if l < r else None)
+                   for l, r, _ in clips]
+        # NOTE: Keep hewing the rest if one fails, and report it in its entry.
+        failed = 0
+        for (left, right, text), future in zip(clips, futures):
+            entry = {'left': left, 'right': right}
+            if future is None:
+                entry['skipped'] = 'empty within the source'
+            else:
+                try:
+                    entry['path'], start = future.result()
+                    # NOTE: Stream copies start at the keyframe before 'left'
+                    if start != left:
+                        entry['start'] = start
+                except Exception as exc:
+                    entry['error'] = str(exc)
+                    failed += 1
+            if text is not None:
+                entry['text'] = text
+            click.echo(json.dumps(entry, ensure_ascii=False))
+
+    if failed:
+        click.secho('Failed to hew %d of %d' % (failed, len(clips)), fg='red', err=True)
+        sys.exit(1)
+
+
+def read_ranges(path):
+    clips = []
+    with open(path) as f:
+        for line in f:
+            line = line.split('#', 1)[0].strip()
+            if not line:
+                continue
+            # NOTE: Accept the format marks are displayed in, like '0:01:02.5 ~ 0:01:05.0'
+            fields = [x for x in re.split(r'[\s,~]+', line) if x]
+            if len(fields) != 2:
+                raise click.BadParameter("Invalid range: '%s'" % line)
+            left, right = (parse_ms(x, line) for x in fields)
+            clips.append((left, right, None))
+    return clips
+
+
+def parse_ms(field, line):
+    # NOTE: Unlike 'parse_timedelta', don't take what can't be parsed as 0
+    seconds = try_seconds(field)
+    if seconds is None:
+        seconds = try_pytimeparse(field)
+    if seconds is None:
+        raise click.BadParameter("Invalid time '%s' in range: '%s'" % (field, line))
+    return int(seconds * 1000)
+
+
+def read_cues(path, padding, duration):
+    clips = []
+    for start, end, text in Cues.load(path, cache_path('subtitles')):
+        left = max(0, start - padding)
+        right = min(end + padding, duration)
+        clips.append((left, right, remove_tags(text).strip()))
+    return clips
+
+
+# NOTE: Clips are opened once per worker process, not per range.
+_worker = {}
+
+
+def init_worker(opts):
+    _worker.update(opts)
+    source_path = opts['source_path']
+    if opts['try_video']:
+        _worker['video'] = VideoFileClip(source_path, fps_source='fps')
+    else:
+        _worker['audio'] = AudioFileClip(source_path)
+    _worker['tracks'] = [(Cues.load(path, cache_path('subtitles')), vpos)
+                         for path, vpos in opts['tracks']]
+
+
+def hew_range(range_):
+    left, right, gain = range_
+    if _worker['try_video']:
+        return export_video(_worker['source_path'],
+                            _worker['video'],
+                            left,
+                            right,
+                            _worker['dirname'],
+                            size=_worker['size'],
+                            audio=_worker['sound'],
+                            copy=_worker['copy'],
+                            tracks=_worker['tracks'],
+                            srt_padding=_worker['srt_padding'],
+                            gain=gain,
+                            hash_name=_worker['hash_name'],
+                            cache=_worker['cache'],
+                            logger=None)
+    else:
+        return export_audio(_worker['audio'], left, right, _worker['dirname'],
+                            gain=gain,
+                            hash_name=_worker['hash_name'],
+                            cache=_worker['cache'],
+                            logger=None)
+
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,263 @@
+from contextlib import contextmanager
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import time
+
+from hew.util import link_or_copy
+
+
+def cache_key(*parts):
+    s = json.dumps(parts, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha1(s.encode('utf-8')).hexdigest()
+
+
+def file_fingerprint(path):
+    # NOTE: Hashing whole sources, which can be several GB, costs more than
+    # most hews. Path, size and mtime are good enough to tell if it changed.
+    st = os.stat(path)
+    return (os.path.realpath(path), st.st_size, st.st_mtime_ns)
+
+
+class ExportCache:
+    # Hewn files are kept in 'blobs' under their own names(sha1 + ext),
+    # hard linked from the target directory when possible, so that
+    # identical hews can be served even after the hewn file is removed
+    # from Anki media or Downloads.
+
+    def __init__(self, dirpath, max_bytes):
+        self.dirpath = dirpath
+        self.max_bytes = max_bytes
+        self._db_path = os.path.join(dirpath, 'exports.sqlite3')
+        self._blobs_path = os.path.join(dirpath, 'blobs')
+        os.makedirs(self._blobs_path, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS exports ('
+                         'key TEXT PRIMARY KEY, '
+                         'filename TEXT NOT NULL, '
+                         'size INTEGER NOT NULL, '
+                         'accessed REAL NOT NULL)')
+
+    def get(self, key, dirname):
+        with self._connect() as conn:
+            row = conn.execute('SELECT filename FROM exports WHERE key = ?',
+                               (key,)).fetchone()
+            if row is None:
+                return None
+
+            filename, = row
+            filepath = os.path.join(dirname, filename)
+            blob = os.path.join(self._blobs_path, filename)
+            if not os.path.exists(filepath):
+                if not os.path.exists(blob):
+                    conn.execute('DELETE FROM exports WHERE key = ?', (key,))
+                    return None
+                link_or_copy(blob, filepath)
+
+            conn.execute('UPDATE exports SET accessed = ? WHERE key = ?',
+                         (time.time(), key))
+            return filepath
+
+    def put(self, key, filepath):
+        filename = os.path.basename(filepath)
+        blob = os.path.join(self._blobs_path, filename)
+        if not os.path.exists(blob):
+            # NOTE: Hard links fail across filesystems, e.g. when Downloads
+            # is on another disk. Don't cache then, rather than copying
+            # every hew into the cache directory.
+            try:
+                os.link(filepath, blob)
+            except OSError:
+                return
+
+        with self._connect() as conn:
+            conn.execute('INSERT OR REPLACE INTO exports VALUES (?, ?, ?, ?)',
+                         (key, filename, os.path.getsize(blob), time.time()))
+            self._evict(conn)
+
+    def _evict(self, conn):
+        total, = conn.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM exports').fetchone()
+        if total <= self.max_bytes:
+            return
+
+        rows = conn.execute(
+            'SELECT key, filename, size FROM exports ORDER BY accessed').fetchall()
+        for key, filename, size in rows:
+            if total <= self.max_bytes:
+                break
+            conn.execute('DELETE FROM exports WHERE key = ?', (key,))
+            total -= size
+            # NOTE: Identical outputs from different keys share a blob.
+            refs, = conn.execute('SELECT COUNT(*) FROM exports WHERE filename = ?',
+                                 (filename,)).fetchone()
+            if refs == 0:
+                blob = os.path.join(self._blobs_path, filename)
+                if os.path.exists(blob):
+                    os.remove(blob)
+
+    def _connect(self):
+        return connect(self._db_path)
+
+
+class ProbeCache:
+    # Keeps what ffmpeg tells about media files,
+    # valid as long as the files are not modified.
+
+    def __init__(self, dirpath):
+        self.dirpath = dirpath
+        self._db_path = os.path.join(dirpath, 'probes.sqlite3')
+        os.makedirs(dirpath, exist_ok=True)
+        with connect(self._db_path) as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS probes ('
+                         'path TEXT PRIMARY KEY, '
+                         'size INTEGER NOT NULL, '
+                         'mtime_ns INTEGER NOT NULL, '
+                         'info TEXT NOT NULL)')
+
+    def get(self, path, probe):
+        realpath, size, mtime_ns = file_fingerprint(path)
+        with connect(self._db_path) as conn:
+            row = conn.execute('SELECT info FROM probes '
+                               'WHERE path = ? AND size = ? AND mtime_ns = ?',
+                               (realpath, size, mtime_ns)).fetchone()
+        if row is not None:
+            return json.loads(row[0])
+
+        info = probe(path)
+        with connect(self._db_path) as conn:
+            conn.execute('INSERT OR REPLACE INTO probes VALUES (?, ?, ?, ?)',
+                         (realpath, size, mtime_ns, json.dumps(info)))
+        return info
+
+
+class TranscriptCache:
+    # Transcripts recognized from clips, keyed by the content of the clip
+    # and the language, so that dumping the same clip twice or
+    # re-hewing the same range doesn't call the recognizer again.
+
+    def __init__(self, dirpath, max_bytes):
+        self.dirpath = dirpath
+        self.max_bytes = max_bytes
+        self._db_path = os.path.join(dirpath, 'transcripts.sqlite3')
+        os.makedirs(dirpath, exist_ok=True)
+        with connect(self._db_path) as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS transcripts ('
+                         'key TEXT PRIMARY KEY, '
+                         'transcript TEXT NOT NULL, '
+                         'size INTEGER NOT NULL, '
+                         'accessed REAL NOT NULL)')
+
+    def get(self, key):
+        with connect(self._db_path) as conn:
+            row = conn.execute('SELECT transcript FROM transcripts WHERE key = ?',
+                               (key,)).fetchone()
+            if row is None:
+                return None
+            conn.execute('UPDATE transcripts SET accessed = ? WHERE key = ?',
+                         (time.time(), key))
+            return row[0]
+
+    def put(self, key, transcript):
+        size = len(transcript.encode('utf-8'))
+        with connect(self._db_path) as conn:
+            conn.execute('INSERT OR REPLACE INTO transcripts VALUES (?, ?, ?, ?)',
+                         (key, transcript, size, time.time()))
+            self._evict(conn)
+
+    def _evict(self, conn):
+        total, = conn.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM transcripts').fetchone()
+        if total <= self.max_bytes:
+            return
+
+        rows = conn.execute(
+            'SELECT key, size FROM transcripts ORDER BY accessed').fetchall()
+        for key, size in rows:
+            if total <= self.max_bytes:
+                break
+            conn.execute('DELETE FROM transcripts WHERE key = ?', (key,))
+            total -= size
+
+
+class YouTubeCache:
+    # Videos downloaded from YouTube by video id and itag, each in its own
+    # directory along with captions downloaded next to it, and the metadata
+    # needed to reopen it without the network.
+    # Entries not accessed for 'ttl' seconds are removed, and so are
+    # the least recently used ones beyond 'max_bytes'.
+
+    def __init__(self, dirpath, max_bytes, ttl):
+        self.dirpath = dirpath
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._db_path = os.path.join(dirpath, 'youtube.sqlite3')
+        os.makedirs(dirpath, exist_ok=True)
+        with connect(self._db_path) as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS videos ('
+                         'video_id TEXT NOT NULL, '
+                         'itag INTEGER NOT NULL, '
+                         'filename TEXT NOT NULL, '
+                         'title TEXT NOT NULL, '
+                         'size INTEGER NOT NULL, '
+                         'accessed REAL NOT NULL, '
+                         'PRIMARY KEY (video_id, itag))')
+
+    def entry_dir(self, video_id, itag):
+        return os.path.join(self.dirpath, '%s.%d' % (video_id, itag))
+
+    def get(self, video_id, itag):
+        with connect(self._db_path) as conn:
+            # NOTE: Evict when opening as well, since cached videos are
+            # opened much more often than new ones are put.
+            self._evict(conn, keep=(video_id, itag))
+            row = conn.execute('SELECT filename, title, size, accessed FROM videos '
+                               'WHERE video_id = ? AND itag = ?',
+                               (video_id, itag)).fetchone()
+            if row is None:
+                return None
+            filename, title, size, accessed = row
+            if accessed < time.time() - self.ttl:
+                return None
+            conn.execute('UPDATE videos SET accessed = ? WHERE video_id = ? AND itag = ?',
+                         (time.time(), video_id, itag))
+        return {'path': os.path.join(self.entry_dir(video_id, itag), filename),
+                'title': title,
+                'size': size}
+
+    def put(self, video_id, itag, filename, title, size):
+        with connect(self._db_path) as conn:
+            conn.execute('INSERT OR REPLACE INTO videos VALUES (?, ?, ?, ?, ?, ?)',
+                         (video_id, itag, filename, title, size, time.time()))
+            self._evict(conn, keep=(video_id, itag))
+
+    def _evict(self, conn, keep):
+        total, = conn.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM videos').fetchone()
+        expires = time.time() - self.ttl
+        rows = conn.execute(
+            'SELECT video_id, itag, size, accessed FROM videos ORDER BY accessed').fetchall()
+        for video_id, itag, size, accessed in rows:
+            if accessed >= expires and total <= self.max_bytes:
+                break
+            # NOTE: Never remove what's being opened, even if it's too large
+            if (video_id, itag) == keep:
+                continue
+            conn.execute('DELETE FROM videos WHERE video_id = ? AND itag = ?',
+                         (video_id, itag))
+            total -= size
+            shutil.rmtree(self.entry_dir(video_id, itag), ignore_errors=True)
+
+
+@contextmanager
+def connect(db_path):
+    # NOTE: Connect for each operation, since hews run on worker threads
+    # and hew-batch runs them on multiple processes.
+    conn = sqlite3.connect(db_path, timeout=30)
+    try:
+        with conn:
+            yield conn
+    finally:
+        conn.close()
@@ -1,49 +1,102 @@
 import os
+import re
 from urllib.parse import parse_qs, urlparse
 
 import click
-import moviepy.audio.fx.all as afx
-from moviepy.editor import AudioFileClip, VideoFileClip
-import pysrt
-from pytube import YouTube
 
-from hew.util import parse_timedelta, Scheme, tempfile_path, tempdir_path, downloads_path
+from hew.cache import ExportCache, ProbeCache, YouTubeCache
+from hew.download import Download, is_downloaded
+from hew.ffmpeg import probe
+from hew.loudness import LoudnessIndex
+from hew.util import (
+    cache_path, parse_timedelta, Scheme, tempfile_path, tempdir_path, downloads_path)
 
 
 scheme = Scheme()
 
 
 @scheme
-def youtube(yt, source):
-    if yt:
-        try:
-            return YouTube(source)
-        except Exception as e:
-            raise RuntimeError('Failed to download YouTube Video')
-
-    else:
+def youtube_cache(yt_cache_size, yt_cache_ttl):
+    if yt_cache_size <= 0:
         return None
+    return YouTubeCache(cache_path('youtube'),
+                        yt_cache_size * 1024 * 1024,
+                        yt_cache_ttl * 24 * 60 * 60)
 
 
 @scheme
-def source_path(youtube, yt_itag, source):
-    if youtube is None:
-        return source
+def youtube_entry(yt, source, yt_itag, youtube_cache):
+    # NOTE: Returns what's needed to open a YouTube video: 'path', 'title' and
+    # 'size', and 'youtube' and 'url' if they are fetched from YouTube.
+    # Videos cached and fully downloaded are opened without the network.
+    if not yt:
+        return None
 
-    dir_ = downloads_path()
-    stream = youtube.streams.get_by_itag(yt_itag)
+    video_id = youtube_video_id(source)
+    cache = youtube_cache if video_id is not None else None
+    if cache is not None:
+        entry = cache.get(video_id, yt_itag)
+        if entry is not None and is_downloaded(entry['path'], entry['size']):
+            click.secho("Cached: '%s'" % entry['path'], fg='yellow')
+            return dict(entry, youtube=None, url=None)
+
+    # NOTE: Import here not to load pytube for local sources
+    from pytube import YouTube
+    try:
+        youtube = YouTube(source)
+    except Exception as e:
+        raise RuntimeError('Failed to download YouTube Video')
 
+    stream = youtube.streams.get_by_itag(yt_itag)
+    dir_ = downloads_path() if cache is None else cache.entry_dir(video_id, yt_itag)
+    os.makedirs(dir_, exist_ok=True)
     video_name = stream.default_filename
-    video_path = os.path.join(dir_, video_name)
+    if cache is not None:
+        cache.put(video_id, yt_itag, video_name, youtube.title, stream.filesize)
+    return {'path': os.path.join(dir_, video_name),
+            'title': youtube.title,
+            'size': stream.filesize,
+            'youtube': youtube,
+            'url': stream.url}
+
+
+@scheme
+def youtube(youtube_entry):
+    # NOTE: None for cached videos as well as local sources
+    return None if youtube_entry is None else youtube_entry['youtube']
+
 
-    click.secho("Download: '%s'" % (video_path), fg='yellow')
-    stream.download(output_path=dir_)
-    return video_path
+@scheme
+def source_download(youtube_entry, yt_connections):
+    if youtube_entry is None:
+        return None
+
+    video_path = youtube_entry['path']
+    if youtube_entry['url'] is not None:
+        click.secho("Download: '%s'" % (video_path), fg='yellow')
+    download = Download(youtube_entry['url'], video_path, youtube_entry['size'],
+                        connections=yt_connections)
+    download.start()
+    return download
+
+
+@scheme
+def source_path(source_download, source):
+    if source_download is None:
+        return source
+
+    # NOTE: Start playing as soon as the beginning is on disk,
+    # while the rest is being downloaded.
+    source_download.wait_playable()
+    return source_download.path
 
 
 @scheme
-def main_path(source_path, download_yt_captions, convert_wav):
+def main_path(source_path, source_download, download_yt_captions, convert_wav):
     if convert_wav:
+        if source_download is not None:
+            source_download.wait()
+        from moviepy.audio.io.AudioFileClip import AudioFileClip
         src = AudioFileClip(source_path)
         filename = os.path.basename(source_path)
         name, _ = os.path.splitext(filename)
@@ -54,6 +107,13 @@ def main_path(source_path, download_yt_captions, convert_wav):
         return source_path
 
 
+@scheme
+def export_cache(export_cache_size):
+    if export_cache_size <= 0:
+        return None
+    return ExportCache(cache_path('exports'), export_cache_size * 1024 * 1024)
+
+
 @scheme
 def start_at_ms(start_at, yt, source):
     if start_at is None:
@@ -70,34 +130,103 @@ def start_at_ms(start_at, yt, source):
     return int(parse_timedelta(start_at) * 1000)
 
 
+def youtube_video_id(url):
+    u = urlparse(url)
+    if u.hostname is not None and u.hostname.endswith('youtu.be'):
+        return u.path.strip('/') or None
+    q = parse_qs(u.query)
+    if 'v' in q:
+        return q['v'][0]
+    m = re.match(r'^/(?:embed|shorts|v)/([\w-]+)', u.path)
+    return m.group(1) if m else None
+
+
 @scheme
 def title(source_path):
     return os.path.basename(source_path)
 
 
 @scheme
-def video(main_path):
-    _, ext = os.path.splitext(main_path)
+def probe_cache():
+    return ProbeCache(cache_path('media'))
 
-    # FIXME: Hard coded to check whenter or not a file is video,
-    # because I failed to figure out a proper way
-    # to differenciate audio files from video files
-    if ext in ('.m4a', '.mp3', '.wav'):
-        return None
-    else:
-        # NOTE: This will be the default option
-        # See https://github.com/Zulko/moviepy/issues/404#issuecomment-650461768
-        return VideoFileClip(main_path, fps_source='fps')
+
+@scheme
+def media_info(main_path, probe_cache, source_download):
+    # NOTE: Streams, duration, size and codecs of the source,
+    # probed once and cached on disk.
+    try:
+        return probe_cache.get(main_path, probe)
+    except RuntimeError:
+        # NOTE: Files with their index at the end can't be probed
+        # until they are fully downloaded.
+        if source_download is None or source_download.finished:
+            raise
+        source_download.wait()
+        return probe_cache.get(main_path, probe)
+
+
+@scheme
+def has_video(media_info):
+    return media_info['video'] is not None
 
 
 @scheme
-def audio(main_path):
+def video_size(media_info, video):
+    if not media_info['video']:
+        return None
+    # NOTE: Fall back to moviepy if the size is not found in what ffmpeg prints
+    size = media_info['video']['size'] or video.size
+    return tuple(size)
+
+
+@scheme.lazy
+def video(main_path, source_download):
+    # NOTE: Opening a clip probes the file with ffmpeg again, and it's only used
+    # to hew. Check 'has_video' first.
+    # It's opened once the source is complete, when it's being downloaded.
+    if source_download is not None:
+        source_download.wait()
+    # NOTE: Import here not to load moviepy until the first hew
+    from moviepy.video.io.VideoFileClip import VideoFileClip
+    # NOTE: This will be the default option
+    # See https://github.com/Zulko/moviepy/issues/404#issuecomment-650461768
+    return VideoFileClip(main_path, fps_source='fps')
+
+
+@scheme.lazy
+def audio(main_path, source_download):
+    if source_download is not None:
+        source_download.wait()
+    # NOTE: Import here not to load moviepy until the first hew
+    from moviepy.audio.io.AudioFileClip import AudioFileClip
     return AudioFileClip(main_path)
 
 
 @scheme
-def duration(audio):
-    return int(audio.duration*1000)
+def loudness_index(main_path, probe_cache, source_download):
+    # NOTE: Stored next to the probe cache.
+    # Until it's built, hews fall back to normalizing on their own.
+    # A source being downloaded is indexed once it's complete.
+    index = LoudnessIndex(main_path, probe_cache.dirpath)
+    index.build_in_background(wait=None if source_download is None else
+                              source_download.wait)
+    return index
+
+
+@scheme
+def duration(media_info):
+    return media_info['duration']
+
+
+@scheme
+def wait_seekable(source_download, duration):
+    # NOTE: Parts not downloaded yet are zeros on disk.
+    # Wait for the part to seek to before VLC reads it.
+    def f(ms):
+        if source_download is not None and duration:
+            source_download.wait_at(ms / duration)
+    return f
 
 
 @scheme
@@ -108,7 +237,7 @@ def clamp(duration):
 
 
 @scheme
-def state(video):
+def state(has_video):
     return {
         'left': 0,
         'right': 0,
@@ -117,8 +246,9 @@ def state(video):
         'last_hewn_path': '',
         'last_hewn-side': 'left',
         'scale': 1.,
-        'try_video': video is not None,  # Toggle with Tab
+        'try_video': has_video,  # Toggle with Tab
         'current_player': 'main',  # main or sub
         'current_target': 'anki',  # anki or downloads
         'before_jump': None,
+        'snap': False,  # Snap marks to silences
     }
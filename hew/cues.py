@@ -0,0 +1,129 @@
+from array import array
+from bisect import bisect_left, bisect_right
+import os
+import struct
+
+import pysrt
+
+from hew.cache import cache_key, file_fingerprint
+from hew.util import tempfile_path
+
+
+# NOTE: Bump this when the file format changes
+CUES_VERSION = 1
+MAGIC = b'HCUE'
+HEADER = struct.Struct('<4sII')  # magic, version, number of cues
+
+
+class Cues:
+    # Cues of an SRT file sorted by start time, kept as arrays of
+    # starts and ends in ms, so that ranges can be looked up by binary search
+    # instead of scanning every cue like 'SubRipFile.slice' does.
+
+    def __init__(self, starts, ends, texts, path=None):
+        self.starts = starts
+        self.ends = ends
+        self.texts = texts
+        self.path = path
+        self._sorted_ends = None
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __iter__(self):
+        return zip(self.starts, self.ends, self.texts)
+
+    @classmethod
+    def load(cls, path, cache_dir=None):
+        # NOTE: Parsing SRTs with pysrt is slow for long ones.
+        # Keep the parsed cues in a compact binary file keyed by
+        # the path, size and mtime of the SRT.
+        cache_file = None
+        if cache_dir is not None:
+            key = cache_key(CUES_VERSION, file_fingerprint(path))
+            cache_file = os.path.join(cache_dir, key + '.cues')
+            if os.path.exists(cache_file):
+                try:
+                    return read_cues(cache_file, path)
+                except (OSError, EOFError, ValueError, struct.error):
+                    # NOTE: Parse again if it's broken
+                    pass
+
+        cues = cls.parse(path)
+        if cache_file is not None:
+            write_cues(cues, cache_file)
+        return cues
+
+    @classmethod
+    def parse(cls, path):
+        items = sorted(((item.start.ordinal, item.end.ordinal, item.text)
+                        for item in pysrt.open(path)),
+                       key=lambda x: x[0])
+        return cls(array('q', (x[0] for x in items)),
+                   array('q', (x[1] for x in items)),
+                   [x[2] for x in items],
+                   path)
+
+    def slice(self, starts_after, ends_before):
+        # NOTE: Same as 'SubRipFile.slice(starts_after=..., ends_before=...)'.
+        # Returns a list of (start, end, text).
+        # Cues may overlap, so ends are not sorted; filter them in the range
+        # narrowed down by starts.
+        i = bisect_right(self.starts, starts_after)
+        j = bisect_left(self.starts, ends_before)
+        return [(self.starts[k], self.ends[k], self.texts[k])
+                for k in range(i, j)
+                if self.ends[k] < ends_before]
+
+    def at(self, t):
+        # NOTE: Returns the last cue started at or before 't' which is still on,
+        # or None.
+        i = bisect_right(self.starts, t)
+        for k in range(i - 1, -1, -1):
+            if self.ends[k] > t:
+                return (self.starts[k], self.ends[k], self.texts[k])
+            # NOTE: Cues rarely overlap much, don't look back too far.
+            if i - k > 8:
+                break
+        return None
+
+    def snap(self, ms, side):
+        # NOTE: Returns the nearest cue start for 'left',
+        # or the nearest cue end for 'right'.
+        if not len(self):
+            return None
+        if side == 'left':
+            points = self.starts
+        else:
+            if self._sorted_ends is None:
+                self._sorted_ends = array('q', sorted(self.ends))
+            points = self._sorted_ends
+        i = bisect_left(points, ms)
+        candidates = [points[k] for k in (i - 1, i) if 0 <= k < len(points)]
+        return min(candidates, key=lambda p: abs(p - ms))
+
+
+def write_cues(cues, cache_file):
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    blob = '\0'.join(cues.texts).encode('utf-8')
+    temppath = tempfile_path('.cues', dir=os.path.dirname(cache_file))
+    with open(temppath, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, CUES_VERSION, len(cues)))
+        cues.starts.tofile(f)
+        cues.ends.tofile(f)
+        f.write(blob)
+    os.replace(temppath, cache_file)
+
+
+def read_cues(cache_file, path):
+    with open(cache_file, 'rb') as f:
+        magic, version, n = HEADER.unpack(f.read(HEADER.size))
+        if magic != MAGIC or version != CUES_VERSION:
+            raise ValueError("Invalid cues file: '%s'" % cache_file)
+        starts = array('q')
+        starts.fromfile(f, n)
+        ends = array('q')
+        ends.fromfile(f, n)
+        blob = f.read().decode('utf-8')
+    texts = blob.split('\0') if n else []
+    return Cues(starts, ends, texts, path)
@@ -0,0 +1,207 @@
+import json
+import os
+import threading
+import urllib.request
+
+import click
+
+from hew.cache import cache_key
+from hew.util import cache_path, tempfile_path
+
+
+# NOTE: YouTube throttles responses larger than about 10 MB,
+# so download in pieces smaller than that, as pytube does.
+PIECE_BYTES = 8 * 1024 * 1024
+# NOTE: Start playing once this much from the beginning is on disk
+PLAYABLE_BYTES = 2 * PIECE_BYTES
+READ_BYTES = 64 * 1024
+RETRIES = 3
+TIMEOUT = 30
+
+
+class Download:
+    # Downloads a file in byte ranges over several connections,
+    # into the target path preallocated to its full size.
+    # Pieces are fetched from the beginning, so the file can be played
+    # while the rest is downloaded, except that pieces being waited for
+    # by 'wait_at' are fetched first. Finished pieces are recorded in the cache
+    # directory, so that an interrupted download resumes where it left off.
+
+    def __init__(self, url, path, size, connections=4):
+        self.url = url
+        self.path = path
+        self.size = size
+        self.connections = connections
+        self.state_path = state_path(path)
+        self.finished = False
+        self.error = None
+        self._done = set()
+        self._pending = []
+        self._wanted = set()
+        self._changed = threading.Condition()
+        self._reported = 0
+
+    @property
+    def npieces(self):
+        return -(-self.size // PIECE_BYTES)  # ceil
+
+    @property
+    def progress(self):
+        return len(self._done) / self.npieces if self.npieces else 1.
+
+    def start(self):
+        if self._prepare():
+            self.finished = True
+            return
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def wait_playable(self):
+        playable = -(-min(PLAYABLE_BYTES, self.size) // PIECE_BYTES)
+        self._wait(lambda: all(i in self._done for i in range(playable)))
+
+    def wait_at(self, fraction):
+        # NOTE: Waits until the part at 'fraction' of the duration is on disk,
+        # to play from there. Its offset is estimated as if the bitrate is
+        # constant, so take from a piece before it to PLAYABLE_BYTES after it.
+        offset = int(self.size * min(max(fraction, 0.), 1.))
+        first = max(offset // PIECE_BYTES - 1, 0)
+        last = min((offset + PLAYABLE_BYTES) // PIECE_BYTES, self.npieces - 1)
+        pieces = range(first, last + 1)
+        with self._changed:
+            self._wanted.update(pieces)
+        self._wait(lambda: all(i in self._done for i in pieces))
+
+    def wait(self):
+        self._wait(lambda: False)
+
+    def _wait(self, ready):
+        with self._changed:
+            while not (self.finished or self.error or ready()):
+                self._changed.wait()
+        if self.error is not None:
+            raise RuntimeError("Failed to download '%s'" % self.path) from self.error
+
+    def _prepare(self):
+        # NOTE: Returns True if it's already downloaded.
+        state = None
+        if os.path.exists(self.state_path):
+            try:
+                with open(self.state_path) as f:
+                    state = json.load(f)
+            except (OSError, ValueError):
+                state = None
+        elif is_downloaded(self.path, self.size):
+            return True
+
+        if (state is None or
+                state['size'] != self.size or
+                state['piece_bytes'] != PIECE_BYTES or
+                not os.path.exists(self.path)):
+            with open(self.path, 'wb') as f:
+                f.truncate(self.size)
+            state = {'size': self.size, 'piece_bytes': PIECE_BYTES, 'done': []}
+            self._save(state)
+        else:
+            click.secho("Resume: '%s' (%d/%d)" %
+                        (self.path, len(state['done']), self.npieces), fg='yellow')
+        self._done = set(state['done'])
+        return False
+
+    def _run(self):
+        self._pending = [i for i in range(self.npieces) if i not in self._done]
+        workers = [threading.Thread(target=self._work, daemon=True)
+                   for _ in range(min(self.connections, len(self._pending)))]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        if self.error is not None:
+            click.secho("Failed to download: '%s'" % str(self.error), fg='red')
+            return
+
+        os.remove(self.state_path)
+        with self._changed:
+            self.finished = True
+            self._changed.notify_all()
+        click.secho("Downloaded: '%s'" % self.path, fg='yellow')
+
+    def _work(self):
+        while True:
+            with self._changed:
+                # NOTE: Stop taking pieces as soon as one fails for good
+                if self.error is not None or not self._pending:
+                    return
+                wanted = [i for i in self._pending if i in self._wanted]
+                i = wanted[0] if wanted else self._pending[0]
+                self._pending.remove(i)
+            try:
+                self._fetch_with_retries(i)
+            except Exception as exc:
+                with self._changed:
+                    if self.error is None:
+                        self.error = exc
+                    self._changed.notify_all()
+                return
+
+    def _fetch_with_retries(self, i):
+        for attempt in range(RETRIES):
+            try:
+                return self._fetch(i)
+            except OSError:
+                if attempt == RETRIES - 1:
+                    raise
+
+    def _fetch(self, i):
+        start = i * PIECE_BYTES
+        end = min(start + PIECE_BYTES, self.size) - 1
+        req = urllib.request.Request(self.url, headers={
+            'Range': 'bytes=%d-%d' % (start, end),
+            'User-Agent': 'Mozilla/5.0',
+        })
+        with urllib.request.urlopen(req, timeout=TIMEOUT) as resp:
+            if resp.status != 206 and start > 0:
+                raise RuntimeError('Range requests are not supported')
+            # NOTE: Pieces don't overlap, so each writes through its own handle
+            with open(self.path, 'r+b') as f:
+                f.seek(start)
+                remaining = end - start + 1
+                while remaining > 0:
+                    data = resp.read(min(READ_BYTES, remaining))
+                    if not data:
+                        raise OSError('Connection closed in piece %d' % i)
+                    f.write(data)
+                    remaining -= len(data)
+
+        with self._changed:
+            self._done.add(i)
+            self._save({'size': self.size,
+                        'piece_bytes': PIECE_BYTES,
+                        'done': sorted(self._done)})
+            self._report()
+            self._changed.notify_all()
+
+    def _save(self, state):
+        dirpath = os.path.dirname(self.state_path)
+        os.makedirs(dirpath, exist_ok=True)
+        temppath = tempfile_path('.json', dir=dirpath)
+        with open(temppath, 'w') as f:
+            json.dump(state, f)
+        os.replace(temppath, self.state_path)
+
+    def _report(self):
+        percent = int(self.progress * 100) // 10 * 10
+        if percent > self._reported:
+            self._reported = percent
+            click.secho('Download: %d%%' % percent, fg='yellow')
+
+
+def state_path(path):
+    # NOTE: Keep it out of the download directory(e.g. ~/Downloads),
+    # keyed by where it's downloaded to.
+    return cache_path('downloads', cache_key(os.path.realpath(path)) + '.json')
+
+
+def is_downloaded(path, size):
+    return (os.path.exists(path) and
+            os.path.getsize(path) == size and
+            not os.path.exists(state_path(path)))
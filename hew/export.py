@@ -0,0 +1,229 @@
+from contextlib import contextmanager
+import os
+
+import click
+from proglog import ProgressBarLogger
+
+from hew.cache import cache_key, file_fingerprint
+from hew.ffmpeg import copy_start, filter_path, has_filter, stream_copy
+from hew.subtitles import compose_subtitles_baked_clip, write_ass
+from hew.util import digestof, tempfile_path
+
+
+def export_video(source_path,
+                 video,
+                 left,
+                 right,
+                 dirname,
+                 size=None,
+                 audio=True,
+                 copy=False,
+                 tracks=(),
+                 srt_padding=0,
+                 gain=None,
+                 hash_name='sha1',
+                 cache=None,
+                 logger='bar'):
+    # NOTE: Returns the path of the hewn file and where it starts in the source,
+    # which is the keyframe before 'left' when it's stream copied.
+    # Burn subtitles in with ffmpeg's 'ass' filter while encoding,
+    # which is much faster than compositing every frame with moviepy.
+    # Fall back to moviepy if ffmpeg is built without libass.
+    bake = (None if not tracks else
+            'ass' if has_filter('ass') else
+            'moviepy')
+    # NOTE: Stream copy can't resize, normalize, or bake subtitles.
+    # '--video-copy' opts out of the first two, so only fall back to
+    # encoding when subtitles are going to be baked.
+    copy = copy and not tracks
+    opts = {
+        'hash_name': hash_name,
+        'size': size,
+        'audio': audio,
+        'srt_padding': srt_padding if tracks else None,
+        'bake': bake,
+        'gain': gain_key(gain),
+    }
+    key = export_key(source_path, left, right, '.mp4', tracks=tracks, copy=copy, **opts)
+    filepath = lookup(cache, key, dirname)
+    if filepath is not None:
+        return filepath, (copy_start(source_path, left) if copy else left)
+
+    temppath = None
+    start = left
+    if copy:
+        temppath, start = try_stream_copy(source_path, left, right, dirname, audio=audio)
+        if temppath is None:
+            # NOTE: Keep what's encoded instead under the key without copy,
+            # so that hews under the copy key always start at the keyframe.
+            key = export_key(source_path, left, right, '.mp4', tracks=tracks, copy=False, **opts)
+            filepath = lookup(cache, key, dirname)
+            if filepath is not None:
+                return filepath, left
+
+    if temppath is None:
+        hewn = subclip(video, left, right, gain)
+        temppath = staging_path(dirname, '.mp4')
+        filters = []
+        ass_path = None
+        if bake == 'ass':
+            composed = hewn
+            ass_path = tempfile_path('.ass')
+            # NOTE: Burn in before scaling, so that subtitles are sized
+            # relative to the source as with moviepy.
+            if write_ass(tracks, hewn.size, left, right, srt_padding, ass_path):
+                filters.append('ass=%s' % filter_path(ass_path))
+        else:
+            composed = compose_subtitles_baked_clip(
+                hewn, tracks, left, right, srt_padding)
+        if size is not None:
+            w, h = size
+            # ffmpeg requires sizes to be even
+            w, h = (w//2)*2, (h//2)*2
+            filters.append('scale=%s:%s' % (w, h))
+        ffmpeg_params = ['-vf', ','.join(filters)] if filters else []
+
+        # Codecs chosen for HTML5
+        try:
+            with removing_on_error(temppath):
+                composed.write_videofile(temppath,
+                                         codec='libx264',
+                                         audio=audio,
+                                         audio_codec='aac',
+                                         ffmpeg_params=ffmpeg_params,
+                                         logger=logger)
+        finally:
+            if ass_path is not None:
+                os.remove(ass_path)
+    filepath = finalize(temppath, dirname, '.mp4', hash_name)
+    store(cache, key, filepath)
+    return filepath, start
+
+
+def export_audio(audio, left, right, dirname,
+                 gain=None, hash_name='sha1', cache=None, logger='bar'):
+    # NOTE: Returns the same as 'export_video', and audio starts at 'left'
+    key = export_key(audio.filename, left, right, '.mp3',
+                     hash_name=hash_name,
+                     gain=gain_key(gain))
+    filepath = lookup(cache, key, dirname)
+    if filepath is not None:
+        return filepath, left
+
+    hewn = subclip(audio, left, right, gain)
+    temppath = staging_path(dirname, '.mp3')
+    with removing_on_error(temppath):
+        hewn.write_audiofile(temppath, logger=logger)
+    filepath = finalize(temppath, dirname, '.mp3', hash_name)
+    store(cache, key, filepath)
+    return filepath, left
+
+
+# NOTE: Bump this when encoding options change,
+# so that hews cached with old options are not reused.
+EXPORT_VERSION = 2
+
+
+def export_key(source_path, left, right, ext, tracks=(), **opts):
+    track_keys = []
+    for srt, vpos in tracks:
+        path = getattr(srt, 'path', None)
+        if path is None:
+            # NOTE: Subtitles not from files can't be fingerprinted
+            return None
+        track_keys.append((file_fingerprint(path), vpos))
+
+    return cache_key(EXPORT_VERSION,
+                     file_fingerprint(source_path),
+                     left,
+                     right,
+                     ext,
+                     track_keys,
+                     opts)
+
+
+def lookup(cache, key, dirname):
+    if cache is None or key is None:
+        return None
+    return cache.get(key, dirname)
+
+
+def store(cache, key, filepath):
+    if cache is None or key is None:
+        return
+    cache.put(key, filepath)
+
+
+def staging_path(dirname, ext):
+    # NOTE: Stage hews in the target directory rather than the system temp
+    # directory, so that finalize() is a rename instead of a copy across
+    # filesystems. The prefix keeps them hidden until they are finalized.
+    return tempfile_path(ext, dir=dirname, prefix='.hew-')
+
+
+def finalize(temppath, dirname, ext, hash_name='sha1'):
+    # NOTE: The mp4 muxer seeks back to write its index,
+    # so the digest can't be computed from the encoder's output stream.
+    # Read the staged file right after it's written, when it's likely
+    # still in the page cache.
+    filename = digestof(temppath, hash_name) + ext
+    filepath = os.path.join(dirname, filename)
+    os.replace(temppath, filepath)
+    return filepath
+
+
+def try_stream_copy(source_path, left, right, dirname, audio):
+    temppath = staging_path(dirname, '.mp4')
+    try:
+        start = stream_copy(source_path, left, right, temppath, audio=audio)
+    except Exception as exc:
+        # NOTE: Some codecs(e.g. VP9 in webm) can't be copied into mp4.
+        # Fall back to encoding in that case.
+        click.secho("Failed to stream copy: '%s'" % str(exc), fg='red')
+        os.remove(temppath)
+        return None, left
+    return temppath, start
+
+
+def gain_key(gain):
+    # NOTE: Hews normalized by their own peak and by the loudness index
+    # sound slightly different, so don't serve one for the other.
+    return 'peak' if gain is None else round(float(gain), 4)
+
+
+def subclip(clip, left, right, gain=None):
+    # NOTE: Import here not to load moviepy until the first hew
+    from moviepy.audio.fx.audio_normalize import audio_normalize
+    from moviepy.audio.fx.volumex import volumex
+
+    # NOTE: 'audio_normalize' decodes the whole range only to find its peak.
+    # Use the gain looked up from the loudness index instead, if given.
+    hewn = clip.subclip(left/1000., right/1000.)
+    return (hewn.fx(audio_normalize) if gain is None else
+            hewn.fx(volumex, gain))
+
+
+@contextmanager
+def removing_on_error(path):
+    try:
+        yield path
+    except BaseException:
+        if os.path.exists(path):
+            os.remove(path)
+        raise
+
+
+class ProgressLogger(ProgressBarLogger):
+    # NOTE: moviepy reports its progress through proglog.
+    # 'report' is called with a fraction between 0 and 1,
+    # and may raise to abort the encoding.
+    def __init__(self, report):
+        super().__init__()
+        self._report = report
+
+    def bars_callback(self, bar, attr, value, old_value=None):
+        if attr != 'index':
+            return
+        total = self.bars[bar].get('total')
+        if total:
+            self._report(min(value / total, 1.))
@@ -0,0 +1,220 @@
+from functools import lru_cache
+import re
+import shutil
+import subprocess
+import tempfile
+
+from moviepy.config import get_setting
+import numpy as np
+
+
+# NOTE: Keyframes are usually a few seconds apart.
+# Look back this far from a mark when searching for the previous keyframe.
+KEYFRAME_LOOKBEHIND_MS = 10000
+
+
+def ffmpeg_binary():
+    # NOTE: Use the same binary moviepy uses,
+    # which is either FFMPEG_BINARY or the one bundled with imageio-ffmpeg.
+    return get_setting('FFMPEG_BINARY')
+
+
+def ffprobe_binary():
+    # NOTE: imageio-ffmpeg doesn't bundle ffprobe.
+    # Returns None if it's not installed.
+    return shutil.which('ffprobe')
+
+
+def run(args):
+    cmd = [ffmpeg_binary(), '-y', '-v', 'error'] + args
+    return subprocess.run(cmd,
+                          stdin=subprocess.DEVNULL,
+                          stdout=subprocess.PIPE,
+                          stderr=subprocess.PIPE,
+                          check=True)
+
+
+@lru_cache(maxsize=None)
+def has_filter(name):
+    # NOTE: Some filters(e.g. 'ass') are only available
+    # when ffmpeg is built with the libraries they need.
+    cmd = [ffmpeg_binary(), '-hide_banner', '-filters']
+    try:
+        out = subprocess.run(cmd,
+                             stdin=subprocess.DEVNULL,
+                             stdout=subprocess.PIPE,
+                             stderr=subprocess.DEVNULL,
+                             check=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return False
+    # NOTE: Lines look like ' ... ass    V->V    Render ASS subtitles ...'
+    for line in out.decode('utf-8', 'replace').splitlines():
+        fields = line.split()
+        if len(fields) >= 2 and fields[1] == name:
+            return True
+    return False
+
+
+def filter_path(path):
+    # NOTE: Quote a path to be used as an option value in a filtergraph.
+    # Quotes protect it from the filtergraph parser, and the option parser
+    # still takes ':' as a separator(e.g. 'C:/' on Windows) unless escaped.
+    # Only for paths made by 'tempfile_path', which never contain quotes.
+    return "'%s'" % path.replace('\\', '/').replace(':', '\\:')
+
+
+def keyframe_before(path, ms):
+    ffprobe = ffprobe_binary()
+    if ffprobe is None:
+        return None
+
+    start = max(0, ms - KEYFRAME_LOOKBEHIND_MS)
+    cmd = [ffprobe, '-v', 'error',
+           '-select_streams', 'v:0',
+           '-skip_frame', 'nokey',
+           '-show_entries', 'frame=best_effort_timestamp_time',
+           '-of', 'csv=p=0',
+           '-read_intervals', '%f%%%f' % (start/1000., ms/1000.),
+           path]
+    try:
+        out = subprocess.run(cmd,
+                             stdin=subprocess.DEVNULL,
+                             stdout=subprocess.PIPE,
+                             stderr=subprocess.DEVNULL,
+                             check=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+    keyframes = []
+    for line in out.decode('utf-8').split():
+        try:
+            keyframes.append(int(float(line.strip(',')) * 1000))
+        except ValueError:
+            continue
+    # NOTE: '-read_intervals' seeks to the keyframe before 'start',
+    # so there can be keyframes outside the range.
+    keyframes = [k for k in keyframes if k <= ms]
+    return max(keyframes) if keyframes else None
+
+
+def copy_start(source_path, left):
+    # NOTE: Stream copy can only cut on keyframes.
+    # Snap 'left' to the previous keyframe so that the cut doesn't start
+    # with broken frames. If ffprobe is unavailable, ffmpeg's own input seeking
+    # does the same snapping implicitly.
+    snapped = keyframe_before(source_path, left)
+    return left if snapped is None else snapped
+
+
+def stream_copy(source_path, left, right, output_path, audio=True):
+    # NOTE: Returns where the copy starts in the source, see 'copy_start'.
+    start = copy_start(source_path, left)
+
+    args = ['-ss', '%.3f' % (start/1000.),
+            '-i', source_path,
+            '-t', '%.3f' % ((right - start)/1000.),
+            '-map', '0:v:0']
+    if audio:
+        args.extend(['-map', '0:a:0?'])
+    else:
+        args.append('-an')
+    args.extend(['-c', 'copy',
+                 '-avoid_negative_ts', 'make_zero',
+                 '-movflags', '+faststart',
+                 output_path])
+    run(args)
+    return start
+
+
+def probe(path):
+    # NOTE: Parse what 'ffmpeg -i' prints, as moviepy does,
+    # since ffprobe may not be installed.
+    cmd = [ffmpeg_binary(), '-hide_banner', '-i', path]
+    # NOTE: ffmpeg exits with 1 since no output file is given.
+    out = subprocess.run(cmd,
+                         stdin=subprocess.DEVNULL,
+                         stdout=subprocess.DEVNULL,
+                         stderr=subprocess.PIPE).stderr.decode('utf-8', 'replace')
+
+    info = {'duration': None, 'video': None, 'audio': None}
+    m = re.search(r'Duration: (\d+):(\d+):(\d+(?:\.\d+)?)', out)
+    if m is not None:
+        h, mi, s = m.groups()
+        info['duration'] = int((int(h)*3600 + int(mi)*60 + float(s)) * 1000)
+
+    for line in out.splitlines():
+        m = re.search(r'Stream #\d+:\d+.*?: (Video|Audio): (\w+)(.*)', line)
+        if m is None:
+            continue
+        kind, codec, rest = m.groups()
+        if kind == 'Video' and info['video'] is None:
+            # NOTE: Cover arts in audio files appear as video streams
+            if '(attached pic)' in rest:
+                continue
+            size = re.search(r' (\d{2,5})x(\d{2,5})[\s,]', rest)
+            fps = re.search(r' (\d+(?:\.\d+)?)k? fps', rest)
+            info['video'] = {
+                'codec': codec,
+                'size': [int(size.group(1)), int(size.group(2))] if size else None,
+                'fps': float(fps.group(1)) if fps else None,
+            }
+        if kind == 'Audio' and info['audio'] is None:
+            hz = re.search(r' (\d+) Hz', rest)
+            info['audio'] = {
+                'codec': codec,
+                'sample_rate': int(hz.group(1)) if hz else None,
+            }
+
+    if info['duration'] is None:
+        raise RuntimeError("Failed to probe '%s'" % path)
+    return info
+
+
+# NOTE: Raw sample formats of ffmpeg by numpy dtype
+PCM_FORMATS = {
+    np.dtype(np.float32): 'f32le',
+    np.dtype(np.int16): 's16le',
+}
+
+
+def decode_pcm(path, rate, channels, chunk_frames=1 << 16, dtype=np.float32):
+    # NOTE: Yields chunks of samples shaped (frames, channels),
+    # decoded, downmixed and resampled by ffmpeg, without going through a file.
+    dtype = np.dtype(dtype)
+    fmt = PCM_FORMATS[dtype]
+    cmd = [ffmpeg_binary(), '-v', 'error',
+           '-i', path,
+           '-vn',
+           '-f', fmt,
+           '-acodec', 'pcm_' + fmt,
+           '-ar', str(rate),
+           '-ac', str(channels),
+           '-']
+    frame_bytes = dtype.itemsize * channels
+    # NOTE: Collect errors in a file rather than a pipe, so that ffmpeg
+    # never blocks on a full stderr while stdout is being read.
+    errors = tempfile.TemporaryFile()
+    p = subprocess.Popen(cmd,
+                         stdin=subprocess.DEVNULL,
+                         stdout=subprocess.PIPE,
+                         stderr=errors,
+                         bufsize=chunk_frames * frame_bytes)
+    try:
+        while True:
+            data = p.stdout.read(chunk_frames * frame_bytes)
+            if not data:
+                break
+            # NOTE: Drop a partial frame at the end, if any
+            n = len(data) // frame_bytes
+            yield np.frombuffer(data[:n * frame_bytes], dtype=dtype).reshape(n, channels)
+        # NOTE: e.g. no audio stream, or audio ffmpeg can't decode
+        if p.wait() != 0:
+            errors.seek(0)
+            message = errors.read().decode('utf-8', 'replace').strip()
+            raise RuntimeError("Failed to decode '%s': %s" % (path, message))
+    finally:
+        p.stdout.close()
+        if p.poll() is None:
+            p.kill()
+        p.wait()
+        errors.close()
@@ -0,0 +1,202 @@
+import os
+import threading
+
+import click
+import numpy as np
+
+from hew.cache import cache_key, file_fingerprint
+from hew.ffmpeg import decode_pcm
+from hew.util import tempfile_path
+
+
+# NOTE: moviepy reads audio at 44100 Hz by default,
+# so compute peaks at the same rate it normalizes at.
+RATE = 44100
+BIN_MS = 10
+BIN_FRAMES = RATE * BIN_MS // 1000
+
+# NOTE: Bump this when the file format changes
+ENVELOPE_VERSION = 1
+
+# NOTE: Bins quieter than this many times the noise floor(10th percentile of RMS)
+# are considered silent, and only silences at least this long are snapped to.
+SILENCE_FLOOR_RATIO = 2.
+SILENCE_MIN_RMS = 10 ** (-50 / 20)  # -50 dBFS
+SILENCE_MIN_MS = 80
+# NOTE: How far from speech the cut is placed within a silence
+SNAP_MARGIN_MS = 100
+SNAP_WINDOW_MS = 1000
+
+
+class LoudnessIndex:
+    # Peak and RMS of the source audio for every BIN_MS,
+    # kept as a memory-mapped file of float32 (peak, rms) pairs.
+    # It's built in background; until then, lookups return None.
+
+    def __init__(self, source_path, dirpath):
+        self.source_path = source_path
+        self.dirpath = dirpath
+        self._envelope = None
+        self._silences = None
+        self._lock = threading.Lock()
+        self._locate()
+        self._load()
+
+    @property
+    def ready(self):
+        return self._envelope is not None
+
+    def build_in_background(self, wait=None):
+        # NOTE: 'wait' blocks until the source is complete, e.g. downloaded.
+        if self.ready:
+            return
+
+        def build():
+            if wait is not None:
+                try:
+                    wait()
+                except RuntimeError:
+                    return
+                # NOTE: The source has changed while waiting
+                self._locate()
+                self._load()
+                if self.ready:
+                    return
+            self.build()
+        threading.Thread(target=build, daemon=True).start()
+
+    def build(self):
+        with self._lock:
+            if self.ready:
+                return
+            try:
+                build_envelope(self.source_path, self.path)
+            except Exception as exc:
+                click.secho("Failed to build loudness index: '%s'" % str(exc), fg='red')
+                return
+            self._load()
+
+    def peak(self, left, right):
+        bins = self._bins(left, right)
+        return None if bins is None else float(bins[:, 0].max())
+
+    def rms(self, left, right):
+        bins = self._bins(left, right)
+        if bins is None:
+            return None
+        return float(np.sqrt(np.mean(np.square(bins[:, 1], dtype=np.float64))))
+
+    def gain(self, left, right):
+        # NOTE: Same as what 'audio_normalize' applies.
+        # Bins on the edges cover a bit outside of the range,
+        # so the gain may be slightly smaller but never clips.
+        peak = self.peak(left, right)
+        if peak is None:
+            return None
+        return 1. / peak if peak > 0 else 1.
+
+    def snap(self, ms, side, direction=0):
+        # NOTE: Returns where to cut near 'ms' for 'side', within a silence:
+        # for 'left', right before the speech after the silence starts,
+        # for 'right', right after the speech before the silence ends.
+        # With direction 0, snaps to the nearest one within SNAP_WINDOW_MS.
+        # With direction +1/-1, jumps to the next/previous one
+        # within SNAP_WINDOW_MS.
+        # Returns None if the index is not ready or there is no silence.
+        if self._envelope is None:
+            return None
+        starts, ends = self._silences
+        margins = np.minimum(SNAP_MARGIN_MS, (ends - starts) // 2)
+        points = (ends - margins if side == 'left' else
+                  starts + margins)
+        if direction > 0:
+            i = np.searchsorted(points, ms, side='right')
+            return (int(points[i]) if i < len(points) and points[i] - ms <= SNAP_WINDOW_MS else
+                    None)
+        if direction < 0:
+            i = np.searchsorted(points, ms, side='left') - 1
+            return (int(points[i]) if i >= 0 and ms - points[i] <= SNAP_WINDOW_MS else
+                    None)
+
+        # NOTE: Already in a silence
+        i = np.searchsorted(starts, ms, side='right') - 1
+        if i >= 0 and ms < ends[i]:
+            return ms
+        if not len(points):
+            return None
+        i = int(np.argmin(np.abs(points - ms)))
+        return int(points[i]) if abs(points[i] - ms) <= SNAP_WINDOW_MS else None
+
+    def _bins(self, left, right):
+        envelope = self._envelope
+        if envelope is None or right <= left:
+            return None
+        a = left // BIN_MS
+        b = -(-right // BIN_MS)  # ceil
+        bins = envelope[a:b]
+        return bins if len(bins) else None
+
+    def _locate(self):
+        key = cache_key(ENVELOPE_VERSION, RATE, BIN_MS,
+                        file_fingerprint(self.source_path))
+        self.path = os.path.join(self.dirpath, key + '.envelope')
+
+    def _load(self):
+        # NOTE: A missing or empty file means it's not built yet.
+        try:
+            if os.path.getsize(self.path) < 2 * 4:
+                return
+            envelope = np.memmap(self.path, dtype=np.float32, mode='r').reshape(-1, 2)
+        except (OSError, ValueError):
+            return
+        # NOTE: Set the envelope last, since it's what marks this ready
+        # to the other threads.
+        self._silences = find_silences(envelope[:, 1])
+        self._envelope = envelope
+
+
+def build_envelope(source_path, path):
+    dirpath = os.path.dirname(path)
+    os.makedirs(dirpath, exist_ok=True)
+    temppath = tempfile_path('.envelope', dir=dirpath)
+    try:
+        frames = 0
+        with open(temppath, 'wb') as f:
+            rest = np.zeros((0, 2), dtype=np.float32)
+            for chunk in decode_pcm(source_path, RATE, 2):
+                frames += len(chunk)
+                samples = np.concatenate([rest, chunk]) if len(rest) else chunk
+                n = len(samples) // BIN_FRAMES
+                f.write(summarize(samples[:n * BIN_FRAMES]).tobytes())
+                rest = samples[n * BIN_FRAMES:]
+            if len(rest):
+                f.write(summarize(rest, len(rest)).tobytes())
+        if not frames:
+            raise RuntimeError("No audio decoded from '%s'" % source_path)
+        os.replace(temppath, path)
+    except BaseException:
+        os.remove(temppath)
+        raise
+
+
+def find_silences(rms):
+    # NOTE: Returns (starts, ends) in ms of silent runs, sorted.
+    if not len(rms):
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    threshold = max(np.percentile(rms, 10) * SILENCE_FLOOR_RATIO, SILENCE_MIN_RMS)
+    silent = np.concatenate([[0], (rms < threshold).astype(np.int8), [0]])
+    edges = np.diff(silent)
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1)
+    long_enough = (ends - starts) * BIN_MS >= SILENCE_MIN_MS
+    return (starts[long_enough].astype(np.int64) * BIN_MS,
+            ends[long_enough].astype(np.int64) * BIN_MS)
+
+
+def summarize(samples, bin_frames=BIN_FRAMES):
+    # NOTE: Peak over all channels, as 'max_volume' does,
+    # and RMS of the channels mixed down.
+    bins = samples.reshape(-1, bin_frames, samples.shape[1])
+    peak = np.abs(bins).max(axis=(1, 2))
+    rms = np.sqrt(np.mean(np.square(bins.mean(axis=2)), axis=1))
+    return np.stack([peak, rms], axis=1).astype(np.float32)
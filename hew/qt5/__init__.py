@@ -5,12 +5,14 @@ from PyQt5.QtCore import QSettings, QEvent
 from PyQt5.QtGui import QFont, QFontMetrics, QPixmap, QIcon, QImage
 from PyQt5.QtWidgets import QApplication
 
-from hew.qt5 import window, shortcut
+from hew.qt5 import jobs, window, shortcut
 from hew.util import Scheme
 
 
-scheme = Scheme(window.scheme,
-                shortcut.scheme)
+scheme = Scheme(jobs.scheme,
+                window.scheme,
+                shortcut.scheme,
+                main_thread=True)
 
 
 @scheme
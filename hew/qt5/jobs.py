@@ -0,0 +1,139 @@
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import traceback
+
+import click
+from PyQt5.QtCore import QObject, pyqtSignal
+
+from hew.export import ProgressLogger
+from hew.util import Scheme
+
+
+scheme = Scheme(main_thread=True)
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class Job:
+    def __init__(self, queue, name, work, done):
+        self.queue = queue
+        self.name = name
+        self.work = work
+        self.done = done
+        self.percent = 0
+        self.future = None
+        self._cancelled = threading.Event()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    @property
+    def logger(self):
+        # NOTE: A proglog logger to pass to moviepy's write_* methods.
+        return ProgressLogger(self.report)
+
+    def cancel(self):
+        self._cancelled.set()
+        # NOTE: Jobs not started yet can be cancelled right away.
+        # Running jobs are aborted on their next progress report.
+        if self.future is not None:
+            self.future.cancel()
+
+    def report(self, fraction):
+        # NOTE: This is called from the worker thread.
+        if self.cancelled:
+            raise JobCancelled()
+        percent = int(fraction * 100)
+        if percent != self.percent:
+            self.percent = percent
+            self.queue.progressed.emit(self)
+
+
+class JobQueue(QObject):
+    # NOTE: These signals are emitted from the worker thread.
+    # Since JobQueue lives in the Qt thread, connected slots are
+    # invoked in the Qt thread through queued connections.
+    progressed = pyqtSignal(object)
+    finished = pyqtSignal(object)
+
+    def __init__(self, maxsize, show_action, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.maxsize = maxsize
+        self._show_action = show_action
+        # NOTE: moviepy clips are not thread-safe,
+        # so run jobs one at a time in submission order.
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._jobs = []
+        self.progressed.connect(self._on_progressed)
+        self.finished.connect(self._on_finished)
+
+    def submit(self, name, work, done):
+        if len(self._jobs) >= self.maxsize:
+            self._show_action('%s: queue full' % name)
+            return None
+
+        job = Job(self, name, work, done)
+        self._jobs.append(job)
+        job.future = self._executor.submit(self._run, job)
+        job.future.add_done_callback(lambda _: self.finished.emit(job))
+        self._show_status()
+        return job
+
+    def cancel_last(self):
+        if not self._jobs:
+            return
+        job = self._jobs[-1]
+        self._show_action('%s: cancelling' % job.name)
+        job.cancel()
+
+    def cancel_all(self):
+        # NOTE: Cancelling a job not started yet finishes it immediately,
+        # which removes it from self._jobs.
+        for job in list(self._jobs):
+            job.cancel()
+
+    def _run(self, job):
+        if job.cancelled:
+            raise JobCancelled()
+        return job.work(job)
+
+    def _on_progressed(self, job):
+        if job in self._jobs:
+            self._show_status()
+
+    def _on_finished(self, job):
+        self._jobs.remove(job)
+        future = job.future
+        if future.cancelled() or isinstance(future.exception(), JobCancelled):
+            self._show_action('%s: cancelled' % job.name)
+            return
+
+        exc = future.exception()
+        if exc is not None:
+            click.secho("Failed to %s: '%s'" % (job.name, str(exc)), fg='red')
+            traceback.print_exception(type(exc), exc, exc.__traceback__)
+            self._show_action('%s: failed' % job.name)
+            return
+
+        job.done(future.result())
+        self._show_status()
+
+    def _show_status(self):
+        if not self._jobs:
+            return
+        running = self._jobs[0]
+        queued = len(self._jobs) - 1
+        s = '%s %d%%' % (running.name, running.percent)
+        if queued:
+            s += ' (+%d)' % queued
+        self._show_action(s)
+
+
+@scheme
+def hew_queue(app, show_action, hew_queue_size):
+    q = JobQueue(hew_queue_size, show_action)
+    app.aboutToQuit.connect(q.cancel_all)
+    return q
@@ -4,7 +4,7 @@ from PyQt5.QtWidgets import QShortcut
 from hew.util import Scheme
 
 
-scheme = Scheme()
+scheme = Scheme(main_thread=True)
 
 
 @scheme
@@ -81,11 +81,26 @@ def shortcut_adjust(shortcut, mark, adjust):
     ]
 
 
+@scheme
+def shortcut_mark_cue(shortcut, mark_cue):
+    return shortcut(['q', 'ㅂ'], mark_cue)
+
+
+@scheme
+def shortcut_toggle_snap(shortcut, toggle_snap):
+    return shortcut(['g', 'ㅎ'], toggle_snap)
+
+
 @scheme
 def shortcut_hew(shortcut, hew):
     return shortcut(['h', 'ㅗ'], hew)
 
 
+@scheme
+def shortcut_cancel_hew(shortcut, cancel_hew):
+    return shortcut(['Shift+h', 'Shift+ㅗ'], cancel_hew)
+
+
 @scheme
 def shortcut_dump_primary(shortcut, dump_primary):
     return shortcut(['d', 'ㅇ'], dump_primary)
@@ -96,6 +111,11 @@ def shortcut_dump_secondary(shortcut, dump_secondary):
     return shortcut(['Shift+d', 'Shift+ㅇ'], dump_secondary)
 
 
+@scheme
+def shortcut_index_transcript(shortcut, index_transcript):
+    return shortcut(['Shift+i', 'Shift+ㅑ'], index_transcript)
+
+
 @scheme
 def shortcut_play_hewn_left(shortcut, play_hewn):
     return shortcut(['r', 'ㄱ'],
@@ -149,11 +169,11 @@ def shortcut_shift(shortcut, window):
 
 
 @scheme
-def shortcut_toggle_try_video(shortcut, video, state,
+def shortcut_toggle_try_video(shortcut, has_video, state,
                               try_video_label, try_video_label_text,
                               label_style_normal, label_style_color):
     def f():
-        try_video = (video is not None) and (not state['try_video'])
+        try_video = has_video and (not state['try_video'])
         if try_video:
             label_style_normal(try_video_label)
         else:
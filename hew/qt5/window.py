@@ -6,7 +6,7 @@ from hew.qt5.mixin import ActivationHandoverMixin, DraggingMixin
 from hew.util import format_timedelta, format_timedelta_range, Scheme
 
 
-scheme = Scheme()
+scheme = Scheme(main_thread=True)
 
 # Window is for keeping the layout as below.
 # +----------------------+
@@ -89,8 +89,8 @@ class PlayerView(ActivationHandoverMixin, QWidget):
 
 
 @scheme
-def main_view(app, video):
-    if video is None:
+def main_view(app, has_video):
+    if not has_video:
         return None
 
     player_view = PlayerView()
@@ -102,8 +102,8 @@ def main_view(app, video):
 
 
 @scheme
-def sub_view(app, video):
-    if video is None:
+def sub_view(app, has_video):
+    if not has_video:
         return None
 
     player_view = PlayerView()
@@ -0,0 +1,169 @@
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+
+from hew.util import Lazy
+
+
+# NOTE: All recognizers take 16-bit mono samples at this rate.
+# 16 kHz is what Google Cloud STT recommends for speech, and is enough for it.
+# Higher rates only make requests larger.
+RATE = 16000
+
+
+class Recognizer:
+    # Base of speech recognizers.
+    # 'recognize' returns a list of (start, end, word) in ms from the start
+    # of the samples, and 'transcribe' returns the text only.
+    # '*_many' do the same for each of chunks, concurrently, in order.
+
+    name = None
+    # NOTE: Longer audio is split at silences into chunks up to this long
+    max_chunk_ms = 55000
+
+    def __init__(self, concurrency=4):
+        self.concurrency = concurrency
+
+    def recognize(self, samples, language_code):
+        raise NotImplementedError
+
+    def transcribe(self, samples, language_code):
+        return ' '.join(word for _, _, word in self.recognize(samples, language_code))
+
+    def recognize_many(self, chunks, language_code):
+        return self._map(self.recognize, chunks, language_code)
+
+    def transcribe_many(self, chunks, language_code):
+        return self._map(self.transcribe, chunks, language_code)
+
+    def _map(self, f, chunks, language_code):
+        chunks = list(chunks)
+        if len(chunks) <= 1:
+            return [f(chunk, language_code) for chunk in chunks]
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            return list(executor.map(lambda chunk: f(chunk, language_code), chunks))
+
+
+class GoogleRecognizer(Recognizer):
+    # Google Cloud STT, or a server speaking the same API at 'endpoint'.
+
+    name = 'google'
+    # NOTE: Synchronous recognition only accepts about a minute of audio.
+    max_chunk_ms = 55000
+
+    def __init__(self, concurrency=4, endpoint=None, **_):
+        super().__init__(concurrency)
+        # NOTE: Create the client on first use, and share it between chunks.
+        self._client = Lazy(google_client, {'endpoint': endpoint})
+
+    def recognize(self, samples, language_code):
+        response = self._request(samples, language_code, enable_word_time_offsets=True)
+        return compose_words(response)
+
+    def transcribe(self, samples, language_code):
+        # NOTE: Google's transcripts keep punctuation and casing words don't.
+        response = self._request(samples, language_code)
+        return compose_transcript(response)
+
+    def _request(self, samples, language_code, **opts):
+        config = {
+            'encoding': 'LINEAR16',
+            'language_code': language_code,
+            'sample_rate_hertz': RATE,
+        }
+        config.update(opts)
+        return self._client.recognize(config, {'content': samples.tobytes()})
+
+
+class VoskRecognizer(Recognizer):
+    # Offline recognizer running on CPU, with a model from
+    # https://alphacephei.com/vosk/models. The model decides the language,
+    # so 'language_code' is ignored.
+
+    name = 'vosk'
+    # NOTE: Vosk takes audio of any length, but shorter chunks
+    # keep all the cores busy.
+    max_chunk_ms = 30000
+    # NOTE: Feed this many frames at a time, as vosk's own examples do
+    FEED_FRAMES = 4000
+
+    def __init__(self, concurrency=None, model=None, **_):
+        if model is None:
+            raise RuntimeError('A model is required for vosk')
+        super().__init__(concurrency or os.cpu_count() or 1)
+        # NOTE: The model is shared between threads, while
+        # a recognizer is created for each chunk.
+        self._model = Lazy(vosk_model, {'path': model})
+
+    def recognize(self, samples, language_code):
+        import vosk
+
+        rec = vosk.KaldiRecognizer(self._model.force(), RATE)
+        rec.SetWords(True)
+        results = []
+        for i in range(0, len(samples), self.FEED_FRAMES):
+            if rec.AcceptWaveform(samples[i:i + self.FEED_FRAMES].tobytes()):
+                results.append(json.loads(rec.Result()))
+        results.append(json.loads(rec.FinalResult()))
+        return [(int(w['start'] * 1000), int(w['end'] * 1000), w['word'])
+                for r in results
+                for w in r.get('result', [])]
+
+
+RECOGNIZERS = {
+    'google': GoogleRecognizer,
+    'vosk': VoskRecognizer,
+}
+
+
+def make_recognizer(name, concurrency=None, **opts):
+    if name not in RECOGNIZERS:
+        raise RuntimeError("Unknown recognizer: '%s'" % name)
+    if concurrency is not None:
+        opts['concurrency'] = concurrency
+    return RECOGNIZERS[name](**opts)
+
+
+def google_client(endpoint=None):
+    # NOTE: Import here since google-cloud-speech(and grpc) takes
+    # a long time to load, and most sessions never use it.
+    from google.cloud import speech_v1
+
+    if endpoint is None:
+        return speech_v1.SpeechClient()
+
+    # NOTE: A plaintext channel to a server speaking the same API
+    import grpc
+    return speech_v1.SpeechClient(channel=grpc.insecure_channel(endpoint))
+
+
+def vosk_model(path):
+    import vosk
+    vosk.SetLogLevel(-1)
+    return vosk.Model(path)
+
+
+def compose_transcript(response):
+    def most_probable(result):
+        # NOTE: According to `SpeechRecognitionResult` reference, the `alternatives`
+        # will contain at least one recognition result, in the order of accuracy.
+        # SEE: https://cloud.google.com/speech-to-text/docs/reference/rpc/google.cloud.speech.v1
+        return result.alternatives[0].transcript
+
+    return ' '.join(most_probable(result) for result in response.results)
+
+
+def compose_words(response):
+    # NOTE: Words of the most probable alternative, as in 'compose_transcript'
+    words = []
+    for result in response.results:
+        for word in result.alternatives[0].words:
+            words.append((duration_ms(word.start_time),
+                          duration_ms(word.end_time),
+                          word.word))
+    return words
+
+
+def duration_ms(d):
+    # NOTE: protobuf Duration
+    return d.seconds * 1000 + d.nanos // 1000000
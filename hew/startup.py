@@ -0,0 +1,124 @@
+import builtins
+import json
+import os
+import threading
+import time
+
+import click
+
+
+class ImportReport:
+    # Records how long each import statement takes,
+    # counting only the outermost one so that nested imports are
+    # attributed to what triggered them.
+
+    def __init__(self):
+        self.entries = []
+        self._local = threading.local()
+        self._original = None
+
+    def install(self):
+        self._original = builtins.__import__
+        builtins.__import__ = self._import
+
+    def uninstall(self):
+        builtins.__import__ = self._original
+
+    def _import(self, name, globals=None, locals=None, fromlist=(), level=0):
+        # NOTE: Imports of modules already loaded are recorded as well,
+        # since 'from a import b' may still load 'a.b'.
+        # They are filtered out by the threshold when printing.
+        if getattr(self._local, 'nested', False):
+            return self._original(name, globals, locals, fromlist, level)
+
+        self._local.nested = True
+        started = time.perf_counter()
+        try:
+            return self._original(name, globals, locals, fromlist, level)
+        finally:
+            elapsed = time.perf_counter() - started
+            self._local.nested = False
+            importer = (globals or {}).get('__name__', '?')
+            self.entries.append((name, importer, elapsed))
+
+    def print(self, total=None, threshold=0.001):
+        entries = sorted(self.entries, key=lambda e: e[2], reverse=True)
+        for name, importer, elapsed in entries:
+            if elapsed < threshold:
+                continue
+            click.secho('%8.3fs  %s (from %s)' % (elapsed, name, importer),
+                        err=True)
+        imports = sum(e[2] for e in entries)
+        click.secho('%8.3fs  imports' % imports, fg='yellow', err=True)
+        if total is not None:
+            click.secho('%8.3fs  until the window is shown' % total,
+                        fg='yellow', err=True)
+
+
+def critical_path(scheme):
+    # NOTE: The longest chain of dependencies by the time spent on building,
+    # which bounds the time to the window no matter how targets are scheduled.
+    finish = {}
+    prev = {}
+    for name, (_, elapsed) in sorted(scheme.timings.items(),
+                                     key=lambda kv: kv[1][0]):
+        deps = [k for k in scheme.dependencies(name) if k in finish]
+        slowest = max(deps, key=finish.get, default=None)
+        finish[name] = elapsed + (finish[slowest] if slowest else 0.)
+        prev[name] = slowest
+
+    if not finish:
+        return [], 0.
+
+    name = max(finish, key=finish.get)
+    total = finish[name]
+    path = []
+    while name is not None:
+        path.append(name)
+        name = prev[name]
+    return list(reversed(path)), total
+
+
+def build_report_json(scheme):
+    path, path_time = critical_path(scheme)
+    targets = [{'name': name,
+                'started': started,
+                'elapsed': elapsed,
+                'dependencies': scheme.dependencies(name)}
+               for name, (started, elapsed) in scheme.timings.items()]
+    total = max((started + elapsed for started, elapsed in scheme.timings.values()),
+                default=0.)
+    return json.dumps({'total': total,
+                       'targets': targets,
+                       'critical_path': path,
+                       'critical_path_time': path_time},
+                      indent=2)
+
+
+def build_report_dot(scheme):
+    path, _ = critical_path(scheme)
+    on_path = set(path)
+    edges_on_path = set(zip(path, path[1:]))
+
+    lines = ['digraph scheme {', '  rankdir=LR;', '  node [shape=box];']
+    for name, (_, elapsed) in scheme.timings.items():
+        attrs = 'label="%s\\n%.1fms"' % (name, elapsed * 1000)
+        if name in on_path:
+            attrs += ', color=red, penwidth=2'
+        lines.append('  "%s" [%s];' % (name, attrs))
+    for name in scheme.timings:
+        for dep in scheme.dependencies(name):
+            attrs = (' [color=red, penwidth=2]' if (dep, name) in edges_on_path else
+                     '')
+            lines.append('  "%s" -> "%s"%s;' % (dep, name, attrs))
+    lines.append('}')
+    return '\n'.join(lines) + '\n'
+
+
+def write_build_report(scheme, path):
+    _, ext = os.path.splitext(path)
+    s = (build_report_dot(scheme) if ext in ('.dot', '.gv') else
+         build_report_json(scheme))
+    with open(path, 'w') as f:
+        f.write(s)
+    click.secho("Build report: '%s'" % path, fg='yellow', err=True)
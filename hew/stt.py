@@ -1,55 +1,279 @@
-import wave
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+import os
+import struct
+import threading
 
-from google.cloud import speech_v1
-from moviepy.editor import AudioFileClip
+import click
+import numpy as np
 
-from hew.util import Scheme, tempfile_path
+from hew.cache import cache_key, file_fingerprint, TranscriptCache
+from hew.cues import Cues, read_cues, write_cues
+from hew.ffmpeg import decode_pcm
+from hew.loudness import BIN_MS, find_silences, summarize
+from hew.recognizers import make_recognizer, RATE
+from hew.util import cache_path, digestof, Scheme
 
 scheme = Scheme()
 
+# NOTE: Bump these when transcripts or the transcript index change
+TRANSCRIPT_VERSION = 2
+TRANSCRIPT_INDEX_VERSION = 1
+# NOTE: Words cut by the marks up to this much are still counted in
+WORD_SLACK_MS = 200
+
+
+@scheme
+def transcript_cache(transcript_cache_size):
+    if transcript_cache_size <= 0:
+        return None
+    return TranscriptCache(cache_path('transcripts'), transcript_cache_size * 1024 * 1024)
+
+
+@scheme.lazy
+def recognizer(stt_engine, stt_concurrency, stt_endpoint, stt_model):
+    # NOTE: Lazy, so that a misconfigured engine(e.g. vosk without a model)
+    # is reported when speech is first recognized, not at startup.
+    return make_recognizer(stt_engine,
+                           concurrency=stt_concurrency,
+                           endpoint=stt_endpoint,
+                           model=stt_model)
+
+
+@scheme
+def recognize_speech(recognizer, transcript_cache):
+    def f(source_path, language_code='en-US'):
+        key = None
+        if transcript_cache is not None:
+            # NOTE: Hewn files are named after their digests, but hash
+            # the content anyway since any file can be recognized.
+            key = cache_key(TRANSCRIPT_VERSION, digestof(source_path, 'sha1'),
+                            language_code, recognizer.name)
+            transcript = transcript_cache.get(key)
+            if transcript is not None:
+                return transcript
+
+        samples = read_pcm(source_path)
+        chunks = split_at_silences(samples, RATE, recognizer.max_chunk_ms)
+        transcripts = recognizer.transcribe_many(chunks, language_code)
+        transcript = ' '.join(t for t in transcripts if t)
+        if key is not None:
+            transcript_cache.put(key, transcript)
+        return transcript
+    return f
+
 
 @scheme
-def recognize_speech():
+def recognize_words(recognizer):
     def f(source_path, language_code='en-US'):
-        wav_path = convert_to_wav(source_path)
-        client = speech_v1.SpeechClient()
-        config = {
-            'language_code': language_code,
-            'sample_rate_hertz': sample_rate_hertz(wav_path),
-        }
-        audio = {
-            'content': content(wav_path),
-        }
-        response = client.recognize(config, audio)
-        return compose_transcript(response)
+        # NOTE: Returns a list of (start, end, word) in ms
+        # for the whole source.
+        words = []
+        batch = []
+
+        def recognize_batch():
+            results = recognizer.recognize_many([chunk for _, chunk in batch], language_code)
+            for (offset_ms, _), chunk_words in zip(batch, results):
+                words.extend((offset_ms + start, offset_ms + end, word)
+                             for start, end, word in chunk_words)
+            batch.clear()
+
+        for offset_ms, chunk in iter_chunks(source_path, recognizer.max_chunk_ms):
+            batch.append((offset_ms, chunk))
+            # NOTE: Don't decode too far ahead of the recognizer
+            if len(batch) >= recognizer.concurrency * 2:
+                recognize_batch()
+        recognize_batch()
+        return words
     return f
 
 
-def convert_to_wav(source_path):
-    clip = AudioFileClip(source_path)
-    wav_path = tempfile_path('.wav')
-    # NOTE: -ac stands for 'audio channels'
-    # Force mono since Google Cloud STT only accepts mono audio
-    ffmpeg_params = ['-ac', '1']
-    clip.write_audiofile(wav_path, ffmpeg_params=ffmpeg_params)
-    return wav_path
+@scheme
+def transcript_index(main_path, stt_engine, source_download):
+    return TranscriptIndex(main_path, cache_path('transcripts'), stt_engine,
+                           wait=None if source_download is None else source_download.wait)
+
+
+class TranscriptIndex:
+    # Words recognized from the whole source with their times,
+    # kept as Cues so that clips are transcribed by binary search
+    # instead of calling the recognizer for each of them.
+    # It's built on demand in background; until then, lookups return None.
+    # 'wait' blocks until the source is complete, e.g. downloaded.
+
+    def __init__(self, source_path, dirpath, engine, language_code='en-US', wait=None):
+        self.source_path = source_path
+        self.dirpath = dirpath
+        self.engine = engine
+        self.language_code = language_code
+        self.building = False
+        self._wait = wait
+        self._cues = None
+        self._lock = threading.Lock()
+        self._locate()
+        self._load()
+
+    @property
+    def ready(self):
+        return self._cues is not None
+
+    def build_in_background(self, recognize_words):
+        if self.ready or self.building:
+            return
+        self.building = True
+        threading.Thread(target=self.build, args=(recognize_words,), daemon=True).start()
+
+    def build(self, recognize_words):
+        with self._lock:
+            if self.ready:
+                return
+            try:
+                if self._wait is not None:
+                    self._wait()
+                    # NOTE: The source has changed while waiting
+                    self._locate()
+                    self._load()
+                    if self.ready:
+                        return
+                words = sorted(recognize_words(self.source_path, self.language_code))
+                if not words:
+                    # NOTE: Don't keep it, or it would never be built again
+                    click.secho('No words recognized; the transcript is not indexed',
+                                fg='red')
+                    return
+                cues = Cues(array('q', (w[0] for w in words)),
+                            array('q', (w[1] for w in words)),
+                            [w[2] for w in words])
+                write_cues(cues, self.path)
+            except Exception as exc:
+                click.secho("Failed to index transcript: '%s'" % str(exc), fg='red')
+                return
+            finally:
+                self.building = False
+            self._cues = cues
+            click.secho("Transcript indexed: %d words" % len(cues), fg='yellow')
+
+    def transcript(self, left, right):
+        cues = self._cues
+        if cues is None:
+            return None
+        words = cues.slice(starts_after=left - WORD_SLACK_MS,
+                           ends_before=right + WORD_SLACK_MS)
+        return ' '.join(text for _, _, text in words)
+
+    def _locate(self):
+        key = cache_key(TRANSCRIPT_INDEX_VERSION, self.engine, self.language_code,
+                        file_fingerprint(self.source_path))
+        self.path = os.path.join(self.dirpath, key + '.cues')
+
+    def _load(self):
+        # NOTE: A missing or broken file means it's not built yet.
+        try:
+            self._cues = read_cues(self.path, None)
+        except (OSError, EOFError, ValueError, struct.error):
+            self._cues = None
+
+
+@scheme
+def speculative_stt(recognize_speech, stt_speculative):
+    if stt_speculative <= 0:
+        return None
+    return SpeculativeRecognizer(recognize_speech, stt_speculative)
+
+
+class SpeculativeRecognizer:
+    # Recognizes each clip in background as soon as it's hewn,
+    # so that the transcript is ready by the time it's dumped.
+    # Only the latest clip matters: older ones are skipped if not started yet,
+    # and their results are dropped.
+
+    def __init__(self, recognize_speech, max_workers):
+        self._recognize_speech = recognize_speech
+        self._executor = ThreadPoolExecutor(max_workers=max_workers,
+                                            thread_name_prefix='stt')
+        self._lock = threading.Lock()
+        self._path = None
+        self._future = None
+
+    def submit(self, path):
+        with self._lock:
+            if self._future is not None:
+                self._future.cancel()
+            self._path = path
+            self._future = self._executor.submit(self._run, path)
+
+    def result(self, path):
+        # NOTE: Waits if it's still running. Returns None if the clip
+        # was not speculated on or it failed, to recognize it as usual.
+        with self._lock:
+            future = self._future if path == self._path else None
+        if future is None:
+            return None
+        try:
+            return future.result()
+        except Exception as exc:
+            click.secho("Failed to recognize in background: '%s'" % str(exc), fg='red')
+            return None
+
+    def _run(self, path):
+        # NOTE: Superseded while waiting for a worker
+        if path != self._path:
+            return None
+        return self._recognize_speech(path)
+
+
+def read_pcm(source_path):
+    # NOTE: Returns 16-bit mono samples at RATE piped from ffmpeg,
+    # which all recognizers take.
+    # NOTE: Raise rather than recognize nothing, which would be cached as ''.
+    chunks = [chunk[:, 0] for chunk in decode_pcm(source_path, RATE, 1, dtype=np.int16)]
+    if not chunks:
+        raise RuntimeError("No audio decoded from '%s'" % source_path)
+    return np.concatenate(chunks)
 
 
-def sample_rate_hertz(wav_path):
-    with wave.open(wav_path, 'rb') as w:
-        return w.getframerate()
+def split_at_silences(samples, rate, max_ms):
+    # NOTE: Cut in the middle of the last silence before the limit,
+    # so that words are not cut in half. Cut at the limit if there's none.
+    total_ms = len(samples) * 1000 // rate
+    if total_ms <= max_ms:
+        return [samples]
 
+    bin_frames = rate * BIN_MS // 1000
+    n = len(samples) // bin_frames
+    floats = samples[:n * bin_frames].astype(np.float32).reshape(-1, 1) / 32768.
+    starts, ends = find_silences(summarize(floats, bin_frames)[:, 1])
+    middles = (starts + ends) // 2
 
-def content(wav_path):
-    with open(wav_path, 'rb') as f:
-        return f.read()
+    cuts = []
+    at = 0
+    while total_ms - at > max_ms:
+        limit = at + max_ms
+        i = np.searchsorted(middles, limit, side='right') - 1
+        at = int(middles[i]) if i >= 0 and middles[i] > at else limit
+        cuts.append(at * rate // 1000)
 
+    bounds = [0] + cuts + [len(samples)]
+    return [samples[a:b] for a, b in zip(bounds, bounds[1:])]
 
-def compose_transcript(response):
-    def most_probable(result):
-        # NOTE: According to `SpeechRecognitionResult` reference, the `alternatives`
-        # will contain at least one recognition result, in the order of accuracy.
-        # SEE: https://cloud.google.com/speech-to-text/docs/reference/rpc/google.cloud.speech.v1
-        return result.alternatives[0].transcript
 
-    return ' '.join(most_probable(result) for result in response.results)
+def iter_chunks(source_path, max_ms):
+    # NOTE: Yields (offset in ms, samples) of chunks split at silences,
+    # decoding as it goes instead of holding the whole source in memory.
+    buf = np.zeros(0, dtype=np.int16)
+    offset = 0
+    for data in decode_pcm(source_path, RATE, 1, dtype=np.int16):
+        buf = np.concatenate([buf, data[:, 0]])
+        # NOTE: Keep enough to find a silence in the last chunk
+        if len(buf) < 2 * max_ms * RATE // 1000:
+            continue
+        *chunks, buf = split_at_silences(buf, RATE, max_ms)
+        for chunk in chunks:
+            yield offset * 1000 // RATE, chunk
+            offset += len(chunk)
+    if len(buf):
+        for chunk in split_at_silences(buf, RATE, max_ms):
+            yield offset * 1000 // RATE, chunk
+            offset += len(chunk)
+    if not offset:
+        raise RuntimeError("No audio decoded from '%s'" % source_path)
@@ -1,14 +1,12 @@
 from collections import OrderedDict
-from io import StringIO
 from pathlib import Path
 import re
+import threading
 
 import click
-from moviepy.editor import CompositeVideoClip, TextClip
-from moviepy.video.tools.subtitles import SubtitlesClip
-import pysrt
 
-from hew.util import Scheme, tempfile_path
+from hew.cues import Cues
+from hew.util import cache_path, Lazy, remove_tags, Scheme
 
 
 scheme = Scheme()
@@ -59,45 +57,59 @@ def download_yt_captions(youtube, source_path):
 
 
 @scheme
-def subtitles_pri_map(source_path, main_vlc):
-    return SubtitlesMap(source_path, main_vlc)
+def subtitles_tracks(source_path, main_vlc):
+    return load_subtitles_tracks(source_path, main_vlc)
 
 
 @scheme
-def subtitles_aux_map(source_path, main_vlc):
-    x = SubtitlesMap(source_path, main_vlc)
+def subtitles_pri_map(subtitles_tracks):
+    return SubtitlesMap(subtitles_tracks)
+
+
+@scheme
+def subtitles_aux_map(subtitles_tracks):
+    x = SubtitlesMap(subtitles_tracks)
     x.cycle()
     return x
 
 
+def load_subtitles_tracks(source_path, main_vlc):
+    # NOTE: Returns an OrderedDict of spu to (name, srt) shared by
+    # the subtitles maps. Each srt is a proxy which parses the SRT file
+    # when it's first used, or None if there is no SRT file for the track.
+    video_path = Path(source_path)
+    dir_ = video_path.parent
+    stem = video_path.stem
+
+    vlc_name_to_code = {l['vlc_name']: l['code']
+                        for l in LANGUAGES_INTERESTED_IN}
+    d = OrderedDict()
+    for spu, bdesc in main_vlc.video_get_spu_description():
+        if spu == SubtitlesMap.DISABLED:
+            continue
+        desc = bdesc.decode('utf-8')
+        # VLC register subtitles like "Track 1 - [English]"
+        m = re.match(r'^Track \d+ - \[(?P<name>[^\]]+)\]', desc)
+        name = m.group('name') if m else 'default'
+        code = vlc_name_to_code.get(name, None)
+        srt_path = (dir_ / f'{stem}.srt' if code is None else
+                    dir_ / f'{stem}.{code}.srt')
+        srt = (Lazy(Cues.load, {'path': str(srt_path),
+                                'cache_dir': cache_path('subtitles')})
+               if srt_path.exists() else None)
+        click.secho("SRT: '%s'" % srt_path, fg='yellow')
+        d[spu] = (name, srt)
+    return d
+
+
 class SubtitlesMap:
     # -1 is a special value VLC uses to signify disabled.
     DISABLED = -1
 
-    def __init__(self, source_path, main_vlc):
+    def __init__(self, subtitles_tracks):
         self.enabled = False
-
-        video_path = Path(source_path)
-        self._dir = video_path.parent
-        self._stem = video_path.stem
-
-        vlc_name_to_code = {l['vlc_name']: l['code']
-                            for l in LANGUAGES_INTERESTED_IN}
-        d = OrderedDict()
-        for spu, bdesc in main_vlc.video_get_spu_description():
-            if spu == self.DISABLED:
-                continue
-            desc = bdesc.decode('utf-8')
-            # VLC register subtitles like "Track 1 - [English]"
-            m = re.match(r'^Track \d+ - \[(?P<name>[^\]]+)\]', desc)
-            name = m.group('name') if m else 'default'
-            code = vlc_name_to_code.get(name, None)
-            srt_path = (self._dir / f'{self._stem}.srt' if code is None else
-                        self._dir / f'{self._stem}.{code}.srt')
-            srt = pysrt.open(str(srt_path)) if srt_path.exists() else None
-            click.secho("SRT: '%s'" % srt_path, fg='yellow')
-            d[spu] = (name, srt)
-        self._loaded_subtitles = d
+        # NOTE: Keep its own order of the shared tracks to cycle through
+        self._loaded_subtitles = OrderedDict(subtitles_tracks)
 
     def current(self):
         # Example data: (2, ('Korean', 'ko'))
@@ -113,6 +125,14 @@ class SubtitlesMap:
         if self._loaded_subtitles:
             self._loaded_subtitles.move_to_end(spu)
 
+    def preload(self):
+        # NOTE: Parse the selected SRT in background, so that
+        # it's likely ready when hewing or dumping.
+        _, spec = self._first()
+        _, srt = spec
+        if srt is not None:
+            threading.Thread(target=srt.force, daemon=True).start()
+
     def _first(self):
         if self._loaded_subtitles:
             return next(iter(self._loaded_subtitles.items()))
@@ -121,30 +141,108 @@ class SubtitlesMap:
 
 
 @scheme
-def compose_subtitles_baked_clip(subtitles_pri_map, subtitles_aux_map):
-    def f(hewn, left, right, srt_padding):
-        clips = [hewn]
-        main_sub = make_subtitlesclip(
-            subtitles_pri_map, hewn.size, left, right, srt_padding, vpos='bottom')
-        if main_sub is not None:
-            clips.append(main_sub)
-        aux_sub = make_subtitlesclip(
-            subtitles_aux_map, hewn.size, left, right, srt_padding, vpos='top')
-        if aux_sub is not None:
-            clips.append(aux_sub)
-        return CompositeVideoClip(clips)
+def subtitles_to_bake(subtitles_pri_map, subtitles_aux_map):
+    def f():
+        # NOTE: Returns a snapshot of the tracks currently selected,
+        # so that hews queued in background are not affected by
+        # toggling or cycling subtitles afterwards.
+        tracks = []
+        for subtitles_map, vpos in ((subtitles_pri_map, 'bottom'),
+                                    (subtitles_aux_map, 'top')):
+            spu, spec = subtitles_map.current()
+            _, srt = spec
+            if spu != SubtitlesMap.DISABLED and srt is not None:
+                tracks.append((srt, vpos))
+        return tracks
 
     return f
 
 
-def make_subtitlesclip(subtitles_map, hewn_size, left, right, srt_padding, vpos):
-    spu, spec = subtitles_map.current()
-    if spu == -1:
-        return None
+def compose_subtitles_baked_clip(hewn, tracks, left, right, srt_padding):
+    # NOTE: Import here not to load moviepy until subtitles are baked with it
+    from moviepy.video.compositing.CompositeVideoClip import CompositeVideoClip
 
-    _, srt = spec
-    subsrt_path = subsrt(srt, left, right, srt_padding)
-    if subsrt_path is None:
+    clips = [hewn]
+    for srt, vpos in tracks:
+        sub = make_subtitlesclip(
+            srt, hewn.size, left, right, srt_padding, vpos=vpos)
+        if sub is not None:
+            clips.append(sub)
+    return CompositeVideoClip(clips)
+
+
+# NOTE: Same look as 'make_subtitlesclip' renders with ImageMagick:
+# white text on a translucent black box.
+ASS_FONT = 'Arial Unicode MS'
+ASS_FONTSIZE = 36
+# NOTE: ASS colours are &HAABBGGRR, where alpha 0 is opaque.
+ASS_WHITE = '&H00FFFFFF'
+ASS_BOX = '&H66000000'
+ASS_ALIGNMENTS = {'bottom': 2, 'top': 8}
+
+
+def write_ass(tracks, hewn_size, left, right, srt_padding, path):
+    # NOTE: Writes the tracks as ASS for ffmpeg's 'ass' filter to burn in
+    # while encoding, instead of compositing TextClips frame by frame.
+    # Returns the number of cues written.
+    w, h = hewn_size
+    margin_w = int(w * 0.1)
+    margin_h = int(h * 0.05)
+
+    lines = ['[Script Info]',
+             'ScriptType: v4.00+',
+             'PlayResX: %d' % w,
+             'PlayResY: %d' % h,
+             'WrapStyle: 0',
+             'ScaledBorderAndShadow: yes',
+             '',
+             '[V4+ Styles]',
+             'Format: Name, Fontname, Fontsize, PrimaryColour, SecondaryColour, '
+             'OutlineColour, BackColour, Bold, Italic, Underline, StrikeOut, '
+             'ScaleX, ScaleY, Spacing, Angle, BorderStyle, Outline, Shadow, '
+             'Alignment, MarginL, MarginR, MarginV, Encoding']
+    for vpos, alignment in ASS_ALIGNMENTS.items():
+        # NOTE: BorderStyle 3 draws an opaque box in OutlineColour
+        lines.append('Style: %s,%s,%d,%s,%s,%s,%s,0,0,0,0,100,100,0,0,3,4,0,%d,%d,%d,%d,1' %
+                     (vpos, ASS_FONT, ASS_FONTSIZE,
+                      ASS_WHITE, ASS_WHITE, ASS_BOX, ASS_BOX,
+                      alignment, margin_w, margin_w, margin_h))
+
+    lines.extend(['',
+                  '[Events]',
+                  'Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text'])
+    n = 0
+    for srt, vpos in tracks:
+        for (start, end), text in subcues(srt, left, right, srt_padding):
+            lines.append('Dialogue: 0,%s,%s,%s,,0,0,0,,%s' %
+                         (ass_time(start), ass_time(end), vpos, ass_text(text)))
+            n += 1
+
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('\n'.join(lines) + '\n')
+    return n
+
+
+def ass_time(seconds):
+    cs = max(0, int(round(seconds * 100)))
+    s, cs = divmod(cs, 100)
+    m, s = divmod(s, 60)
+    h, m = divmod(m, 60)
+    return '%d:%02d:%02d.%02d' % (h, m, s, cs)
+
+
+def ass_text(text):
+    # NOTE: Braces start override tags in ASS
+    text = remove_tags(text).replace('{', '(').replace('}', ')')
+    return text.replace('\r', '').replace('\n', '\\N')
+
+
+def make_subtitlesclip(srt, hewn_size, left, right, srt_padding, vpos):
+    from moviepy.video.VideoClip import TextClip
+    from moviepy.video.tools.subtitles import SubtitlesClip
+
+    cues = subcues(srt, left, right, srt_padding)
+    if not cues:
         return None
 
     w, h = hewn_size
@@ -171,7 +269,7 @@ def make_subtitlesclip(subtitles_map, hewn_size, left, right, srt_padding, vpos)
                         font='ArialUnicode', fontsize=36, color='white',
                         bg_color='rgba(0,0,0,0.6)')
 
-    subtitlesclip = SubtitlesClip(subsrt_path, make_textclip)
+    subtitlesclip = SubtitlesClip(cues, make_textclip)
 
     def blit_on(self, picture, t):
         # Monkey patch 'blit_on' to place subtitle relative to its dynamic size
@@ -204,22 +302,11 @@ def make_subtitlesclip(subtitles_map, hewn_size, left, right, srt_padding, vpos)
     return subtitlesclip
 
 
-def subsrt(srt, left, right, srt_padding):
+def subcues(srt, left, right, srt_padding):
+    # NOTE: Returns the cues in the range shifted to start from 'left',
+    # as '((start, end), text)' in seconds, which 'SubtitlesClip' takes
+    # as it is without reading an SRT file.
     sliced = srt.slice(starts_after=left - srt_padding,
                        ends_before=right + srt_padding)
-    if not sliced:
-        return None
-
-    # NOTE: The result of slice still references srt items in
-    # the original srt. There seems no way a way to deep copy,
-    # So export as a text and recreate from it.
-    buf = StringIO()
-    sliced.write_into(buf)
-    ss = pysrt.from_string(buf.getvalue())
-
-    # Do some modifications on it.
-    ss.clean_indexes()
-    ss.shift(milliseconds=-left)
-    path = tempfile_path('.srt')
-    ss.save(path, encoding='utf-8')
-    return path
+    return [(((start - left) / 1000., (end - left) / 1000.), text)
+            for start, end, text in sliced]
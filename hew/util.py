@@ -1,51 +1,268 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 import hashlib
-from inspect import getargspec
+import heapq
+from inspect import signature
 import os
 from pathlib import Path
 import re
+import shutil
 import tempfile
+import threading
+import time
 
 
 import pytimeparse
 
 
 class Scheme:
-    def __init__(self, *schemes):
+    # 'main_thread' pins all targets of the scheme to the main thread
+    # when building in parallel. Targets creating or touching Qt widgets
+    # should be built there.
+    def __init__(self, *schemes, main_thread=False):
         self.targets = {}
+        self.pinned = set()
+        self.lazy_targets = set()
+        self._main_thread = main_thread
+        self._argnames = {}
+        self._plans = {}
+        self._proxies = []
+        # NOTE: (started, elapsed) in seconds from the start of the last build
+        self.timings = {}
         for scheme in schemes:
-            for f in scheme.targets.values():
-                self(f)
+            for name, f in scheme.targets.items():
+                self._register(f, scheme._argnames[name],
+                               main_thread or name in scheme.pinned)
+                if name in scheme.lazy_targets:
+                    self.lazy_targets.add(name)
 
     def __call__(self, f):
+        self._register(f, argnames(f), self._main_thread)
+        return f
+
+    def main_thread(self, f):
+        self._register(f, argnames(f), True)
+        return f
+
+    def lazy(self, f):
+        # NOTE: Lazy targets are built on first access through a proxy,
+        # or in background by warm(). Their dependencies are still built eagerly.
+        # Since the proxy itself is never None, lazy targets shouldn't return None.
+        self(f)
+        self.lazy_targets.add(f.__name__)
+        return f
+
+    def warm(self):
+        # NOTE: Build lazy targets not built yet in background.
+        # Lazy targets pinned to the main thread are left to be built on access.
+        proxies = [p for name, p in self._proxies if name not in self.pinned]
+
+        def run():
+            for p in proxies:
+                try:
+                    p.force()
+                except Exception:
+                    # NOTE: The error will be raised again on access
+                    pass
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def _register(self, f, names, pinned):
         name = f.__name__
 
         if name in self.targets:
             raise RuntimeError("Name conflicts: '%s': (%r, %r)" %
                                (name, self.targets[name], f))
         self.targets[name] = f
-        return f
+        self._argnames[name] = names
+        if pinned:
+            self.pinned.add(name)
+        self._plans.clear()
+
+    def build(self, ctx, max_workers=1):
+        self.timings = {}
+        self._proxies = []
+        origin = time.perf_counter()
+        plan = self.plan(ctx.keys())
+        if max_workers > 1:
+            self._build_parallel(ctx, plan, origin, max_workers)
+            return
+
+        for name in plan:
+            _, ctx[name] = self._run(name, ctx, origin)
+
+    def _run(self, name, ctx, origin):
+        f = self.targets[name]
+        kwargs = {k: ctx[k] for k in self._argnames[name]}
+        return self._call(name, f, kwargs, origin)
+
+    def _call(self, name, f, kwargs, origin):
+        started = time.perf_counter()
+        if name in self.lazy_targets:
+            value = Lazy(f, kwargs)
+            self._proxies.append((name, value))
+        else:
+            value = f(**kwargs)
+        self.timings[name] = (started - origin, time.perf_counter() - started)
+        return name, value
+
+    def _build_parallel(self, ctx, plan, origin, max_workers):
+        # NOTE: Targets not pinned run on a thread pool as soon as
+        # their dependencies are built. Pinned ones run on this thread
+        # in the order of the plan. ctx is only written on this thread.
+        order = {name: i for i, name in enumerate(plan)}
+        indegrees = {name: len([k for k in self._argnames[name] if k in order])
+                     for name in plan}
+        dependents = {name: [] for name in plan}
+        for name in plan:
+            for k in self._argnames[name]:
+                if k in order:
+                    dependents[k].append(name)
+
+        ready_main = []
+        running = set()
+
+        def done(name, value):
+            ctx[name] = value
+            for d in dependents[name]:
+                indegrees[d] -= 1
+                if indegrees[d] == 0:
+                    schedule(d)
+
+        def schedule(name):
+            if name in self.pinned:
+                heapq.heappush(ready_main, order[name])
+            else:
+                f = self.targets[name]
+                kwargs = {k: ctx[k] for k in self._argnames[name]}
+                running.add(executor.submit(self._call, name, f, kwargs, origin))
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            try:
+                for name in plan:
+                    if indegrees[name] == 0:
+                        schedule(name)
+
+                while ready_main or running:
+                    finished = {future for future in running if future.done()}
+                    if not finished and not ready_main:
+                        finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        running.remove(future)
+                        done(*future.result())
+
+                    if ready_main:
+                        name = plan[heapq.heappop(ready_main)]
+                        done(*self._run(name, ctx, origin))
+            except BaseException:
+                for future in running:
+                    future.cancel()
+                raise
+
+    def dependencies(self, name):
+        return [k for k in self._argnames[name] if k in self.targets]
+
+    def plan(self, inputs):
+        # NOTE: Plans only depend on which inputs are given, not their values.
+        key = frozenset(inputs)
+        if key not in self._plans:
+            self._plans[key] = self._compile(key)
+        return self._plans[key]
+
+    def _compile(self, inputs):
+        names = [name for name in self.targets if name not in inputs]
+        order = {name: i for i, name in enumerate(names)}
+
+        missing = {}
+        for name in names:
+            m = [k for k in self._argnames[name]
+                 if k not in inputs and k not in self.targets]
+            if m:
+                missing[name] = m
+        if missing:
+            raise RuntimeError("Missing inputs: %s" %
+                               ', '.join('%s(%s)' % (name, ', '.join(m))
+                                         for name, m in missing.items()))
 
-    def build(self, ctx):
-        next_ = dict(self.targets)
-        while next_:
-            targets, next_ = next_, {}
-            for name, f in targets.items():
-                ok = try_run(f, ctx)
-                if not ok:
-                    next_[name] = f
-            if next_ == targets:
-                raise RuntimeError("Cannot resolve dependencies: %r" %
-                                   list(targets.keys()))
-
-
-def try_run(f, ctx):
-    argnames = getargspec(f)[0]
-    if all(k in ctx for k in argnames):
-        kwargs = {k: ctx[k] for k in argnames}
-        ctx[f.__name__] = f(**kwargs)
-        return True
-    else:
-        return False
+        # NOTE: Kahn's algorithm. Among targets ready to be built,
+        # the one registered first goes first, to keep the build order stable.
+        dependents = {name: [] for name in names}
+        indegrees = {}
+        for name in names:
+            deps = [k for k in self._argnames[name] if k in order]
+            indegrees[name] = len(deps)
+            for k in deps:
+                dependents[k].append(name)
+
+        ready = [order[name] for name in names if indegrees[name] == 0]
+        heapq.heapify(ready)
+        plan = []
+        while ready:
+            name = names[heapq.heappop(ready)]
+            plan.append(name)
+            for d in dependents[name]:
+                indegrees[d] -= 1
+                if indegrees[d] == 0:
+                    heapq.heappush(ready, order[d])
+
+        if len(plan) != len(names):
+            unresolved = [name for name in names if indegrees[name] > 0]
+            cycle = self._find_cycle(unresolved)
+            raise RuntimeError("Cyclic dependencies: %s" % ' -> '.join(cycle))
+        return plan
+
+    def _find_cycle(self, unresolved):
+        # NOTE: Every unresolved target depends on another unresolved one,
+        # so following dependencies must revisit a target eventually.
+        unresolved = set(unresolved)
+        name = min(unresolved, key=list(self.targets).index)
+        path = []
+        while name not in path:
+            path.append(name)
+            name = next(k for k in self._argnames[name] if k in unresolved)
+        return path[path.index(name):] + [name]
+
+
+class Lazy:
+    # A proxy building its value on first access.
+    # It's safe to access from multiple threads; the value is built only once.
+
+    def __init__(self, f, kwargs):
+        object.__setattr__(self, '_lazy_f', f)
+        object.__setattr__(self, '_lazy_kwargs', kwargs)
+        object.__setattr__(self, '_lazy_lock', threading.Lock())
+        object.__setattr__(self, '_lazy_built', False)
+        object.__setattr__(self, '_lazy_value', None)
+
+    def force(self):
+        if not self._lazy_built:
+            with self._lazy_lock:
+                if not self._lazy_built:
+                    value = self._lazy_f(**self._lazy_kwargs)
+                    object.__setattr__(self, '_lazy_value', value)
+                    object.__setattr__(self, '_lazy_built', True)
+        return self._lazy_value
+
+    def __getattr__(self, name):
+        return getattr(self.force(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self.force(), name, value)
+
+    def __call__(self, *args, **kwargs):
+        return self.force()(*args, **kwargs)
+
+    def __bool__(self):
+        return bool(self.force())
+
+    def __len__(self):
+        return len(self.force())
+
+    def __iter__(self):
+        return iter(self.force())
+
+
+def argnames(f):
+    return list(signature(f).parameters)
 
 
 def format_timedelta(ms1):
@@ -84,8 +301,8 @@ def remove_tags(s):
     return re.sub(r'<[^>]*>', '', s)
 
 
-def tempfile_path(ext, dir=None):
-    fd, path = tempfile.mkstemp(ext, dir=dir)
+def tempfile_path(ext, dir=None, prefix=None):
+    fd, path = tempfile.mkstemp(ext, prefix, dir)
     os.close(fd)
     return path
 
@@ -98,13 +315,39 @@ def downloads_path():
     return str(Path.home() / 'Downloads')
 
 
+def cache_path(*names):
+    base = os.environ.get('XDG_CACHE_HOME') or str(Path.home() / '.cache')
+    return os.path.join(base, 'hew', *names)
+
+
+def link_or_copy(src, dst):
+    # NOTE: Hard links fail across filesystems
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+HASHES = {
+    'sha1': hashlib.sha1,
+    # NOTE: Use the same digest size as SHA-1 to keep names in the same length
+    'blake2b': lambda: hashlib.blake2b(digest_size=20),
+}
+
+
 def sha1of(filepath):
-    sha1 = hashlib.sha1()
-    bufsize = 1024*1024  # 1 MB
-    with open(filepath, 'rb') as f:
+    return digestof(filepath, 'sha1')
+
+
+def digestof(filepath, hash_name):
+    h = HASHES[hash_name]()
+    # NOTE: Reuse a single buffer instead of allocating one per chunk
+    buf = bytearray(1024*1024)  # 1 MB
+    view = memoryview(buf)
+    with open(filepath, 'rb', buffering=0) as f:
         while True:
-            data = f.read(bufsize)
-            if not data:
+            n = f.readinto(buf)
+            if not n:
                 break
-            sha1.update(data)
-    return sha1.hexdigest()
+            h.update(view[:n])
+    return h.hexdigest()
@@ -16,17 +16,20 @@ def vlc_instance(vlc_quiet):
     return vlc.Instance(params)
 
 
-@scheme
+@scheme.main_thread
 def main_vlc(vlc_instance,
              main_view,
              main_path,
-             start_at_ms):
+             start_at_ms,
+             wait_seekable):
     p = vlc_instance.media_player_new(main_path)
 
     # NOTE: only support macOS currently
     if main_view is not None:
         nsview = int(main_view.winId())
         p.set_nsobject(nsview)
+    if start_at_ms > 0:
+        wait_seekable(start_at_ms)
     p.play()
     p.set_time(start_at_ms)
     # Wait until the video starts
@@ -35,7 +38,7 @@ def main_vlc(vlc_instance,
     return p
 
 
-@scheme
+@scheme.main_thread
 def sub_vlc(vlc_instance, sub_view):
     p = vlc_instance.media_player_new()
     if sub_view is not None:
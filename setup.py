@@ -20,6 +20,7 @@ setup(
     entry_points={
         'console_scripts': [
             'hew=hew.__main__:cli',
+            'hew-batch=hew.batch:cli',
         ]
     },
 
@@ -27,6 +28,9 @@ setup(
         'Click==6.7',
         'google-cloud-speech==1.3.2',
         'moviepy==1.0.3',
+        # NOTE: Same bounds as moviepy 1.0.3's, which used to bring them in
+        'numpy>=1.17.3',
+        'proglog<=1.0.0',
         'pyperclip==1.6.0',
         'PyQt5==5.15',
         'pysrt==1.1.1',
@@ -35,6 +39,11 @@ setup(
         'pytube3>=9.5.0',
     ],
 
+    extras_require={
+        # NOTE: Offline speech recognition with '--stt-engine vosk'
+        'vosk': ['vosk'],
+    },
+
     classifiers=[
         'License :: OSI Approved :: GNU General Public License v3 (GPLv3)',
         'Programming Language :: Python :: 3.6',